@@ -0,0 +1,98 @@
+'''
+Publishes static assets (images, stylesheet, and icon) under names containing
+digests of their contents, so they can be served as immutable: when an asset
+changes, so does its name, and browsers and CDNs never keep a stale copy.
+Only the generated HTML, which refers to the assets by these names, needs to
+be revalidated.
+'''
+
+from json import dumps, loads
+import os
+
+from imagemeta import file_digest
+from atomic import READ_SIZE, write_if_changed, write_stream
+
+# Written into the publishing directory, mapping original paths to new ones
+MANIFEST_FILENAME = 'manifest.json'
+# Compressed copies of published assets, written beside them by output.py
+PRECOMPRESSED_EXTENSIONS = ('.gz', '.br')
+
+def publish(directory, assets):
+    '''
+    Publishes each asset in iterable assets, tuples of string relative path
+    and string digest (or None, if it should be computed here), into string
+    directory under the same relative path with the digest inserted before
+    the extension. Files are copied rather than hard-linked, since an
+    original edited in place would otherwise change its published copy too;
+    only new digests need copying, though, and each is written atomically
+    (see atomic.write_stream) so that an interrupted copy is never taken as
+    published.
+    Removes anything listed in the previous manifest which is no longer
+    needed (and nothing else, so directory may safely hold other files),
+    writes the manifest, and returns it: a dictionary of original paths to
+    published paths, both with "/" separators as used in HTML.
+    '''
+    manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+    previous = load_manifest(manifest_path)
+    manifest = dict()
+    for path, digest in assets:
+        if not inside(path):
+            # Its published copy would be outside directory
+            raise ValueError('cannot publish %s, which is not a relative path'
+                ' within the current directory' % path)
+        if not digest:
+            with open(path, 'rb') as fp:
+                digest = file_digest(fp)
+        root, ext = os.path.splitext(path)
+        published = os.path.join(directory, '%s.%s%s' % (root, digest, ext))
+        if not os.path.exists(published):
+            os.makedirs(os.path.dirname(published), exist_ok=True)
+            with open(path, 'rb') as fp:
+                write_stream(
+                    published, iter(lambda: fp.read(READ_SIZE), b''))
+        manifest[path.replace(os.path.sep, '/')] = published.replace(
+            os.path.sep, '/')
+    for p in set(previous.values()) - set(manifest.values()):
+        # A manifest edited by hand mustn't remove anything elsewhere
+        if not contains(directory, p):
+            continue
+        for f in (p,) + tuple(p + e for e in PRECOMPRESSED_EXTENSIONS):
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+    os.makedirs(directory, exist_ok=True)
+    write_if_changed(
+        manifest_path, dumps(manifest, indent=1, sort_keys=True).encode())
+    return manifest
+
+def load_manifest(path):
+    '''
+    Returns the manifest at string path as written by publish, or an empty
+    dictionary if there is none (or it isn't one).
+    '''
+    try:
+        with open(path) as fp:
+            manifest = loads(fp.read())
+    except (OSError, ValueError):
+        return dict()
+    if not isinstance(manifest, dict):
+        return dict()
+    return {k: v for k, v in manifest.items() if isinstance(v, str)}
+
+def inside(path):
+    '''
+    Returns whether string path is relative and doesn't lead outside the
+    current directory, so that it can be published within a directory.
+    '''
+    path = os.path.normpath(path)
+    return not (os.path.isabs(path) or path == os.pardir
+        or path.startswith(os.pardir + os.path.sep))
+
+def contains(directory, path):
+    '''
+    Returns whether string path is string directory or anything within it,
+    following symbolic links.
+    '''
+    directory = os.path.realpath(directory)
+    return os.path.commonpath((directory, os.path.realpath(path))) == directory
@@ -0,0 +1,74 @@
+'''
+Writes files atomically: each is written to a temporary file beside it and
+then moved into place, so that no reader (another thread, another run, or a
+web server) ever sees one half written. A file whose contents are unchanged
+is left alone, keeping its modification time.
+'''
+
+from hashlib import sha256
+import os
+from threading import get_ident
+
+READ_SIZE = 65536
+
+def write_if_changed(path, contents):
+    '''
+    Writes bytes contents to a file at string path as write_stream does.
+    '''
+    return write_stream(path, (contents,))
+
+def write_stream(path, pieces):
+    '''
+    Writes iterable pieces (strings, encoded as UTF-8, or bytes) one at a
+    time to a temporary file beside string path, and then replaces the file
+    at path with it atomically, so that it's never left incomplete.
+    If the file at path already had exactly these contents, it's left alone
+    (keeping its modification time) and the temporary file is removed.
+    Returns whether the file at path was replaced.
+    '''
+    temp = temp_path(path)
+    h = sha256()
+    try:
+        with open(temp, 'wb') as fp:
+            for piece in pieces:
+                if isinstance(piece, str):
+                    piece = piece.encode('utf-8')
+                h.update(piece)
+                fp.write(piece)
+            size = fp.tell()
+        if existing_digest(path, size) == h.digest():
+            os.remove(temp)
+            return False
+        os.replace(temp, path)
+    except BaseException:
+        # Such as an exception from whatever generated pieces
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    return True
+
+def temp_path(path):
+    '''
+    Returns the path of a temporary file beside string path, unique to this
+    process and thread, for writing before it replaces the file at path.
+    Every file written atomically is written this way, so that leftovers of
+    an interrupted write are all recognizably named.
+    '''
+    return '%s.%d-%d.tmp' % (path, os.getpid(), get_ident())
+
+def existing_digest(path, size):
+    '''
+    Returns the SHA-256 digest of the file at string path as bytes, or None
+    if it doesn't exist or isn't integer size bytes long (in which case it
+    can't be the same as a file of that size anyway).
+    '''
+    h = sha256()
+    try:
+        with open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size != size:
+                return None
+            for block in iter(lambda: fp.read(READ_SIZE), b''):
+                h.update(block)
+    except FileNotFoundError:
+        return None
+    return h.digest()
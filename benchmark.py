@@ -0,0 +1,213 @@
+'''
+Benchmarks each agency's DataParser against responses recorded with
+manybusesaway.py --record, entirely offline, so that a slow change to an
+agency's parsing shows up before it reaches a real build.
+For each agency, getting its resources from the recording (including any
+parsing done by its CustomRequests while bodies arrive, such as King
+County's PatternRequest), update() (with sanitize_strings()), and to_html()
+are each timed separately over several runs, and the median time is
+reported along with how much it varied and the throughput this gives, in
+bytes of responses parsed (or HTML generated) per second and routes per
+second.
+Results can be saved as a baseline, and later results compared to it:
+    python3 benchmark.py <recording> [--save <file>] [--compare <file>]
+No recording is included with this program, since agencies' pages change
+and aren't ours to distribute; one must first be made with --record (while
+online), and kept for as long as results should be comparable.
+'''
+
+import argparse
+import gc
+from importlib import import_module
+from json import dumps, loads
+import statistics
+import sys
+from sys import stderr
+from time import perf_counter
+
+from manybusesaway import DEFAULT_AGENCIES_ORDER
+import requests
+from requests import CustomRequest
+
+# Default number of timed runs of each phase, after one untimed run
+REPETITIONS = 10
+# Slowdown relative to the baseline, as a fraction, reported as a regression
+THRESHOLD = 0.1
+PHASES = ('requests', 'update', 'to_html')
+RESULT_FORMAT = '%-10s %-8s %9.3f ms ±%6.3f %9.2f MB/s %10.0f routes/s'
+BASELINE_FORMAT = '  (baseline %.3f ms, %+.1f%%%s)'
+MISSING_MSG = 'No recorded responses for %s, skipping'
+
+def parse_args():
+    '''
+    This function uses an argparse.ArgumentParser to parse arguments.
+    Returns argparse.Namespace which contains necessary flags and data.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'recording',
+        type=str,
+        help='directory written by manybusesaway.py --record')
+    parser.add_argument(
+        '-n',
+        '--repetitions',
+        type=repetitions,
+        default=REPETITIONS,
+        help='number of timed runs of each phase (at least 1)')
+    parser.add_argument(
+        '--save',
+        type=str,
+        metavar='FILE',
+        help='save results as a baseline')
+    parser.add_argument(
+        '--compare',
+        type=str,
+        metavar='FILE',
+        help='compare results to a saved baseline')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=THRESHOLD,
+        help='slowdown (as a fraction) reported as a regression')
+    parser.add_argument(
+        'agencies',
+        nargs='*',
+        type=str,
+        help='agencies to benchmark (by default, all of them)')
+    return parser.parse_args()
+
+def repetitions(value):
+    '''
+    Returns string value as an integer number of repetitions, for argparse,
+    raising argparse.ArgumentTypeError if it isn't at least 1.
+    '''
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError('must be an integer of at least 1')
+    return n
+
+def get_resources(data_parser):
+    '''
+    Returns a dictionary of DataParser data_parser's INITIAL_REQUESTS to
+    their results, as given to its update method, or None if any is missing
+    from the recording. CustomRequests are performed again every time, as
+    they may parse their responses themselves; other requests are memoized.
+    '''
+    resources = dict()
+    for r in data_parser.INITIAL_REQUESTS:
+        if isinstance(r, CustomRequest):
+            resources[r] = requests.perform(r)
+        else:
+            resources[r] = requests.request_one(r)
+        if resources[r] is None:
+            return None
+    return resources
+
+def run(route_module, agency):
+    '''
+    Runs each phase once for the DataParser from route_module for string
+    agency, and returns a dictionary of phases to tuples of the seconds it
+    took, bytes it processed, and routes it produced, or None if responses
+    it needs weren't recorded.
+    Reading recorded responses from disk is timed in the requests phase, so
+    that it isn't counted as parsing; requests which DataParsers make in
+    update() are memoized, so they're only read in the first, untimed run.
+    '''
+    results = dict()
+    loaded = requests.RECORDER.loaded
+    data_parser = route_module.DataParser(agency, False)
+    gc.collect()
+    start = perf_counter()
+    resources = get_resources(data_parser)
+    if resources is None:
+        return None
+    requests_time = perf_counter() - start
+    requests_loaded = requests.RECORDER.loaded - loaded
+    gc.collect()
+    start = perf_counter()
+    data_parser.update(resources)
+    data_parser.sanitize_strings()
+    update_time = perf_counter() - start
+    routes = len(data_parser.routelistings)
+    results['requests'] = (requests_time, requests_loaded, routes)
+    results['update'] = (
+        update_time, requests.RECORDER.loaded - loaded, routes)
+    gc.collect()
+    start = perf_counter()
+    html = data_parser.to_html()
+    results['to_html'] = (
+        perf_counter() - start, len(html.encode('utf-8')), routes)
+    return results
+
+def benchmark(agency, repetitions):
+    '''
+    Benchmarks string agency's DataParser, and returns a dictionary of
+    phases to dictionaries of statistics, or None if responses it needs
+    weren't recorded.
+    Bytes are counted in the first, untimed run, since later runs reuse the
+    responses (but not the parsing) of earlier ones.
+    '''
+    route_module = import_module('routes.' + agency)
+    first = run(route_module, agency)
+    if first is None:
+        return None
+    times = {phase: [] for phase in PHASES}
+    for i in range(repetitions):
+        for phase, result in run(route_module, agency).items():
+            times[phase].append(result[0])
+    stats = dict()
+    for phase in PHASES:
+        median = statistics.median(times[phase])
+        stats[phase] = {
+            'median': median,
+            'stdev': statistics.stdev(times[phase])
+                if len(times[phase]) > 1 else 0.0,
+            'bytes_per_second': first[phase][1] / median if median else 0.0,
+            'routes_per_second': first[phase][2] / median if median else 0.0}
+    return stats
+
+def main():
+    '''
+    Entry point of program.
+    Benchmarks each agency, printing results (compared to a baseline, if
+    given), and saves them if asked. Exits with status 1 if anything
+    regressed beyond the threshold.
+    '''
+    args = parse_args()
+    # Responses are memoized, so that only parsing is measured
+    requests.configure(replay_dir=args.recording, memoize=True)
+    baseline = dict()
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = loads(fp.read())
+    results = dict()
+    regressed = False
+    for agency in args.agencies or DEFAULT_AGENCIES_ORDER:
+        stats = benchmark(agency, args.repetitions)
+        if stats is None:
+            print(MISSING_MSG % agency, file=stderr)
+            continue
+        results[agency] = stats
+        for phase, s in stats.items():
+            line = RESULT_FORMAT % (agency, phase, s['median'] * 1000,
+                s['stdev'] * 1000, s['bytes_per_second'] / 1e6,
+                s['routes_per_second'])
+            old = baseline.get(agency, {}).get(phase)
+            if old:
+                change = s['median'] / old['median'] - 1
+                slower = change > args.threshold
+                regressed |= slower
+                line += BASELINE_FORMAT % (old['median'] * 1000,
+                    change * 100, ', REGRESSION' if slower else '')
+            print(line)
+    if args.save:
+        with open(args.save, 'w') as fp:
+            fp.write(dumps(results, indent=1))
+    if regressed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
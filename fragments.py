@@ -0,0 +1,92 @@
+'''
+Caches each agency's rendered table (and its completion counts) between
+runs, so that an agency whose inputs haven't changed needn't be updated,
+sorted, or rendered again.
+An agency's inputs are its module's code (and the shared code in routes),
+the resources it was given, what's known about its images, and the options
+affecting how it's rendered, along with the timezone and locale its dates
+are rendered in; a digest of all of them is its key.
+'''
+
+from hashlib import sha256
+from json import dumps, loads
+import locale
+import os
+import sys
+import time
+
+import routes
+from atomic import write_if_changed
+from requests import CustomRequest
+
+class FragmentCache:
+    '''
+    On-disk cache of one fragment per agency, in a JSON file of its key,
+    HTML, and completed() counts; a fragment is only used if its key matches.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, data_parser, resources, options):
+        '''
+        Returns the key of the fragment DataParser data_parser would render
+        after being updated with dictionary resources (as given to its
+        update method), where iterable options are any others affecting it.
+        '''
+        h = sha256()
+        for module in (routes, sys.modules[data_parser.__module__]):
+            with open(module.__file__, 'rb') as fp:
+                h.update(fp.read())
+        # Requests are ordered by a name which is stable between runs
+        for name, value in sorted(
+                ((request_name(r), v) for r, v in resources.items()),
+                key=lambda item: item[0]):
+            h.update(dumps((name, value)).encode())
+        if data_parser.image_index:
+            for name, entry in sorted(data_parser.image_index.entries.items()):
+                # Inodes and modification times don't affect the HTML
+                h.update(dumps((name, entry.key, entry.delisted, entry.time,
+                    entry.digest, entry.width, entry.height)).encode())
+        h.update(dumps(list(options)).encode())
+        # Dates are rendered in the local timezone, formatted for the locale
+        h.update(dumps((time.tzname, time.timezone, time.altzone,
+            locale.getlocale(locale.LC_TIME))).encode())
+        return h.hexdigest()
+
+    def load(self, agency, key):
+        '''
+        Returns a tuple of the HTML and a tuple of completed() counts cached
+        for string agency under string key, or None if there isn't one.
+        '''
+        try:
+            with open(self.path(agency)) as fp:
+                entry = loads(fp.read())
+        except (OSError, ValueError):
+            return None
+        if entry.get('key') != key:
+            return None
+        return entry['html'], tuple(entry['completed'])
+
+    def store(self, agency, key, html, completed):
+        '''
+        Stores string html and tuple completed (of completed() counts) for
+        string agency under string key, replacing whatever was there.
+        '''
+        entry = {'key': key, 'html': html, 'completed': completed}
+        write_if_changed(self.path(agency), dumps(entry).encode())
+
+    def path(self, agency):
+        '''Returns the path of the file for string agency.'''
+        return os.path.join(self.directory, agency + '.json')
+
+def request_name(request):
+    '''
+    Returns a string naming request (as described for requests.request_all)
+    which is the same between runs, unlike the hashes of CustomRequests.
+    '''
+    if isinstance(request, CustomRequest):
+        # Some, like PatternRequests, are for a URL
+        return ' '.join(filter(None, (type(request).__module__ + '.'
+            + type(request).__qualname__, getattr(request, 'url', None))))
+    return dumps(request)
@@ -0,0 +1,431 @@
+'''
+Reads metadata from the headers of route images without decoding any pixel
+data, so that even very large image collections can be scanned quickly.
+Only the first few kilobytes of each file are mapped into memory and read.
+'''
+
+import ctypes
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from json import dumps, loads
+import mmap
+import os
+import struct
+
+from atomic import write_if_changed
+
+# EXIF data must be within this many bytes of the start of a file to be found
+# An APP1 segment can't be larger than 64 KiB, and is usually near the start
+HEADER_LIMIT = 65536
+# TIFF tags used in EXIF: DateTimeOriginal, then DateTimeDigitized
+# DateTime isn't used, since editing (such as cropping) changes it
+EXIF_IFD_TAG = 0x8769
+DATETIME_TAGS = (0x9003, 0x9004)
+OFFSET_TAGS = {0x9003: 0x9011, 0x9004: 0x9012}
+EXIF_TIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+# These are for Linux statx(2), which is not exposed by the os module
+AT_FDCWD = -100
+STATX_BTIME = 0x800
+STATX_SIZE = 256
+STATX_MASK_OFFSET = 0
+STATX_BTIME_OFFSET = 80
+# Kept in each image directory by ImageIndex; can be committed with images
+MANIFEST_FILENAME = '.manifest.json'
+MANIFEST_VERSION = 1
+# Hex digits of each image's SHA-256 hash kept
+HASH_LENGTH = 16
+
+class ImageEntry:
+    '''
+    What is known about one image file: string key (the route it shows),
+    bool delisted (whether its filename starts with *), float time (when it
+    was captured, as from capture_time), and string digest (of its contents),
+    along with the integer inode, size, and modification time (in ns) of the
+    file when these were derived, which tell whether they're still valid.
+    Integers width and height are its dimensions in pixels, or 0 if they
+    couldn't be read (so that they aren't tried again until the file
+    changes), or None if it was indexed before dimensions were.
+    '''
+    # The order of these is the order of fields in the manifest
+    # New fields are added at the end, so older manifests can still be read
+    FIELDS = ('key', 'delisted', 'time', 'digest', 'inode', 'size', 'mtime',
+        'width', 'height')
+
+    def __init__(self, *values):
+        for field, value in zip(self.FIELDS, values):
+            setattr(self, field, value)
+        # Older manifests may not have all fields
+        for field in self.FIELDS[len(values):]:
+            setattr(self, field, None)
+
+    def to_list(self):
+        '''Returns a list of this entry's values, for the manifest.'''
+        return [getattr(self, field) for field in self.FIELDS]
+
+    def matches(self, stat):
+        '''Returns whether os.stat_result stat is of this entry's file.'''
+        return (self.inode, self.size, self.mtime) == (
+            stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+class ImageIndex:
+    '''
+    Persistent index of the images in one directory, stored in a compact
+    manifest file there. Scanning the directory only reads the contents of
+    files whose inode, size, or modification time has changed since they were
+    last indexed; and for those, if the contents haven't changed (as after a
+    git checkout), the capture time already indexed is kept, so committing
+    the manifest with the images preserves their dates.
+    '''
+    def __init__(self, directory, pattern):
+        '''
+        Loads the index of string directory, if there is one. Only files whose
+        names match re.Pattern pattern are indexed, and its first group is the
+        key of each.
+        '''
+        self.directory = directory
+        self.pattern = pattern
+        self.path = os.path.join(directory, MANIFEST_FILENAME)
+        self.entries = dict()
+        self.changed = False
+        try:
+            with open(self.path) as fp:
+                manifest = loads(fp.read())
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.entries = {
+                    name: ImageEntry(*values)
+                    for name, values in manifest['images'].items()}
+        except (OSError, ValueError, AttributeError, TypeError):
+            # A missing or unreadable manifest just means a full scan
+            pass
+
+    def scan(self):
+        '''
+        Brings the index up to date with the directory, returning a dictionary
+        of filenames to ImageEntries for every image in it (none, if it
+        doesn't exist).
+        '''
+        entries = dict()
+        try:
+            with os.scandir(self.directory) as it:
+                dir_entries = list(it)
+        except FileNotFoundError:
+            # A directory that was removed (as while watching) has no images
+            dir_entries = []
+        for dir_entry in dir_entries:
+            name = dir_entry.name
+            match = self.pattern.match(name)
+            if name == MANIFEST_FILENAME or not match:
+                continue
+            try:
+                if not dir_entry.is_file():
+                    continue
+                stat = dir_entry.stat()
+                entry = self.entries.get(name)
+                if not entry or not entry.matches(stat):
+                    entry = self.derive(name, match, stat, entry)
+                elif entry.width is None:
+                    # Indexed before dimensions were
+                    path = os.path.join(self.directory, name)
+                    entry.width, entry.height = known_size(path)
+                    self.changed = True
+            except OSError:
+                # Removed during the scan, or unreadable
+                continue
+            entries[name] = entry
+        if entries.keys() != self.entries.keys():
+            self.changed = True
+        self.entries = entries
+        return entries
+
+    def derive(self, name, match, stat, old_entry=None):
+        '''
+        Returns a new ImageEntry for file name, with re.Match match of its
+        name and os.stat_result stat, reusing the time of ImageEntry
+        old_entry if its contents are unchanged.
+        '''
+        path = os.path.join(self.directory, name)
+        with open(path, 'rb') as fp:
+            digest = file_digest(fp)
+        if old_entry and old_entry.digest == digest:
+            time = old_entry.time
+        else:
+            time = capture_time(path)
+        width, height = known_size(path)
+        self.changed = True
+        return ImageEntry(match.group(1), name.startswith('*'), time, digest,
+            stat.st_ino, stat.st_size, stat.st_mtime_ns, width, height)
+
+    def save(self):
+        '''
+        Writes the manifest if the index has changed since it was loaded.
+        Failing to write it (as for a read-only directory) isn't an error.
+        '''
+        if not self.changed:
+            return
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'images': {
+                name: entry.to_list()
+                for name, entry in sorted(self.entries.items())}}
+        try:
+            write_if_changed(
+                self.path, dumps(manifest, separators=(',', ':')).encode())
+            self.changed = False
+        except OSError:
+            pass
+
+def file_digest(fp):
+    '''
+    Returns the hex digest identifying the contents of binary file object fp.
+    '''
+    h = sha256()
+    while chunk := fp.read(65536):
+        h.update(chunk)
+    return h.hexdigest()[:HASH_LENGTH]
+
+def capture_time(path):
+    '''
+    Returns the time (in seconds since the epoch, as from os.stat) at which
+    the image file at string path was captured.
+    This is the EXIF DateTimeOriginal of a JPEG, PNG, or WebP image if it has
+    one; otherwise the file's birth time, from os.stat where supported or
+    statx(2) on Linux; otherwise, as a last resort, its modification time.
+    Raises OSError if the file can't be read.
+    '''
+    header = read_header(path)
+    secs = exif_time(header) if header else None
+    if secs is None:
+        secs = birth_time(path)
+    if secs is None:
+        secs = os.stat(path).st_mtime
+    return secs
+
+def read_header(path, limit=HEADER_LIMIT):
+    '''
+    Returns up to the first limit bytes (or all bytes, if limit is None) of
+    the file at path as a memoryview over a read-only mmap, or an empty bytes
+    if the file is empty.
+    Only the pages actually accessed are read from disk.
+    '''
+    with open(path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if not size:
+            return b''
+        if limit:
+            size = min(size, limit)
+        # The mapping remains valid after the file is closed
+        mapped = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+    return memoryview(mapped)
+
+def image_size(path):
+    '''
+    Returns a tuple of the width and height in pixels of the image at string
+    path, read from its header, or (None, None) if its format isn't one of
+    JPEG, PNG (including APNG), GIF, BMP, WebP, or AVIF, or it's malformed.
+    The whole file is mapped, since a JPEG's dimensions can follow large
+    metadata segments, but only the pages needed are read.
+    '''
+    try:
+        return header_size(read_header(path, None)) or (None, None)
+    except (OSError, struct.error):
+        return None, None
+
+def known_size(path):
+    '''
+    Returns image_size(path), but with 0 in place of None, as is recorded in
+    an ImageEntry for an image whose dimensions couldn't be read.
+    '''
+    width, height = image_size(path)
+    return width or 0, height or 0
+
+def header_size(header):
+    '''
+    Returns a tuple of the width and height in pixels of the image whose
+    bytes-like header is given, or None if they can't be found.
+    Raises struct.error if the header is truncated.
+    '''
+    if header[:2] == b'\xff\xd8':
+        # JPEG: dimensions are in the first start of frame segment
+        i = 2
+        while i + 4 <= len(header) and header[i] == 0xff:
+            marker = header[i + 1]
+            # Padding bytes may precede a marker
+            if marker == 0xff:
+                i += 1
+                continue
+            # SOF0 through SOF15, except DHT, JPG, and DAC
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack_from('>HH', header, i + 5)
+                return width, height
+            if marker == 0xda:
+                return None
+            i += 2 + struct.unpack_from('>H', header, i + 2)[0]
+    elif header[:8] == b'\x89PNG\r\n\x1a\n':
+        # PNG and APNG: IHDR is always the first chunk
+        if header[12:16] == b'IHDR':
+            return struct.unpack_from('>II', header, 16)
+    elif header[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack_from('<HH', header, 6)
+    elif header[:2] == b'BM':
+        # Height is negative for top-down bitmaps
+        width, height = struct.unpack_from('<ii', header, 18)
+        return width, abs(height)
+    elif header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        kind = header[12:16]
+        if kind == b'VP8 ':
+            # Lossy: 14-bit dimensions after the frame tag and start code
+            width, height = struct.unpack_from('<HH', header, 26)
+            return width & 0x3fff, height & 0x3fff
+        if kind == b'VP8L':
+            # Lossless: 14-bit dimensions minus one, packed after a signature
+            bits = struct.unpack_from('<I', header, 21)[0]
+            return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if kind == b'VP8X':
+            # Extended: 24-bit canvas dimensions minus one
+            width = int.from_bytes(header[24:27], 'little') + 1
+            height = int.from_bytes(header[27:30], 'little') + 1
+            return width, height
+    elif header[4:8] == b'ftyp' and header[8:12] in (b'avif', b'avis'):
+        # AVIF: dimensions are in the first image spatial extents property
+        i = bytes(header[:HEADER_LIMIT]).find(b'ispe')
+        if i >= 4:
+            return struct.unpack_from('>II', header, i + 8)
+    return None
+
+def exif_tiff(header):
+    '''
+    Returns the TIFF structure of the EXIF data within bytes-like header of a
+    JPEG, PNG, or WebP file, or None if there isn't any.
+    '''
+    if header[:2] == b'\xff\xd8':
+        # JPEG: a sequence of marker segments, each with a 2-byte length
+        i = 2
+        while i + 4 <= len(header) and header[i] == 0xff:
+            marker = header[i + 1]
+            length = struct.unpack_from('>H', header, i + 2)[0]
+            if marker == 0xe1 and header[i + 4:i + 10] == b'Exif\0\0':
+                return header[i + 10:i + 2 + length]
+            # Start of scan; image data follows, so there's no EXIF
+            if marker == 0xda:
+                return None
+            i += 2 + length
+    elif header[:8] == b'\x89PNG\r\n\x1a\n':
+        # PNG: a sequence of chunks, with 4-byte lengths and 4-byte CRCs
+        i = 8
+        while i + 8 <= len(header):
+            length = struct.unpack_from('>I', header, i)[0]
+            kind = header[i + 4:i + 8]
+            if kind == b'eXIf':
+                return header[i + 8:i + 8 + length]
+            if kind == b'IDAT':
+                return None
+            i += 12 + length
+    elif header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        # WebP: a sequence of RIFF chunks, padded to even lengths
+        i = 12
+        while i + 8 <= len(header):
+            length = struct.unpack_from('<I', header, i + 4)[0]
+            if header[i:i + 4] == b'EXIF':
+                tiff = header[i + 8:i + 8 + length]
+                # Some encoders keep the JPEG-style identifier
+                if tiff[:6] == b'Exif\0\0':
+                    tiff = tiff[6:]
+                return tiff
+            i += 8 + length + (length & 1)
+    return None
+
+def exif_time(header):
+    '''
+    Returns the capture time, in seconds since the epoch, recorded in the
+    EXIF data in bytes-like header, or None if there isn't one.
+    Times without a recorded offset are taken to be local time.
+    '''
+    tiff = exif_tiff(header)
+    if not tiff or len(tiff) < 8:
+        return None
+    order = {b'II': '<', b'MM': '>'}.get(bytes(tiff[:2]))
+    if not order:
+        return None
+    try:
+        ifd0_offset = struct.unpack_from(order + 'I', tiff, 4)[0]
+        ifd0 = read_ifd(tiff, order, ifd0_offset)
+        tags = dict(ifd0)
+        if EXIF_IFD_TAG in ifd0:
+            tags.update(read_ifd(tiff, order, ifd0[EXIF_IFD_TAG]))
+    except struct.error:
+        return None
+    for tag in DATETIME_TAGS:
+        if tag not in tags:
+            continue
+        try:
+            dt = datetime.strptime(tags[tag], EXIF_TIME_FORMAT)
+        except (TypeError, ValueError):
+            # Unknown times are sometimes recorded as blanks or colons
+            continue
+        offset = tags.get(OFFSET_TAGS[tag])
+        if isinstance(offset, str) and len(offset) == 6:
+            try:
+                hours, minutes = int(offset[:3]), int(offset[4:])
+                dt = dt.replace(tzinfo=timezone(timedelta(
+                    hours=hours, minutes=minutes if hours >= 0 else -minutes)))
+            except ValueError:
+                pass
+        return dt.timestamp()
+    return None
+
+def read_ifd(tiff, order, offset):
+    '''
+    Returns a dictionary of the tags in the TIFF image file directory at
+    integer offset in bytes-like tiff, with string struct byte order order.
+    Only ASCII values (as strings) and LONG values (as integers) are read,
+    as those are the only types needed.
+    Raises struct.error if the directory is truncated.
+    '''
+    tags = dict()
+    count = struct.unpack_from(order + 'H', tiff, offset)[0]
+    for i in range(offset + 2, offset + 2 + count * 12, 12):
+        tag, kind, n = struct.unpack_from(order + 'HHI', tiff, i)
+        if kind == 2:
+            # ASCII, stored inline if 4 bytes or shorter
+            start = i + 8
+            if n > 4:
+                start = struct.unpack_from(order + 'I', tiff, i + 8)[0]
+            value = bytes(tiff[start:start + n]).split(b'\0')[0]
+            tags[tag] = value.decode('ascii', 'replace').strip()
+        elif kind == 4:
+            tags[tag] = struct.unpack_from(order + 'I', tiff, i + 8)[0]
+    return tags
+
+def birth_time(path):
+    '''
+    Returns the birth (creation) time of the file at path, in seconds since
+    the epoch, or None if neither the platform nor its filesystem provide it.
+    '''
+    stat = os.stat(path)
+    if hasattr(stat, 'st_birthtime'):
+        return stat.st_birthtime
+    return statx_birth_time(path)
+
+def statx_birth_time(path):
+    '''
+    Returns the birth time of the file at path using Linux statx(2) through
+    ctypes, or None if that's unavailable (or the filesystem doesn't record
+    birth times).
+    '''
+    statx = getattr(LIBC, 'statx', None)
+    if not statx:
+        return None
+    buffer = ctypes.create_string_buffer(STATX_SIZE)
+    if statx(AT_FDCWD, os.fsencode(path), 0, STATX_BTIME, buffer):
+        return None
+    mask = struct.unpack_from('I', buffer, STATX_MASK_OFFSET)[0]
+    if not mask & STATX_BTIME:
+        return None
+    secs, nsecs = struct.unpack_from('qI', buffer, STATX_BTIME_OFFSET)
+    return secs + nsecs / 1e9
+
+try:
+    # Symbols of the C library already loaded into this process
+    LIBC = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    LIBC = None
@@ -9,35 +9,57 @@ See project README.md for details and LICENSE.txt for license.
 '''
 
 import argparse
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
+from itertools import repeat
 import re
 from datetime import datetime
 from time import time
 import locale
+import os
+from sys import stderr
+import threading
 
-from requests import request_all
+import assets
+import atomic
+import output
+import requests
+import routes
+import snapshots
+import tracing
+from fragments import FragmentCache
+from requests import prefetch, configure
+from serve import Site, Refresher, serve
+from thumbnails import ThumbnailStage
+from watch import Watcher
+from requests import MAX_CONNECTIONS, MAX_PER_HOST
+from requests import CONNECT_TIMEOUT, READ_TIMEOUT, DEADLINE
 
 DEFAULT_AGENCIES_ORDER = (
     'king', 'sound', 'everett', 'community', 'pierce', 'intercity', 'kitsap',
     'skagit', 'whatcom', 'lewis', 'pacific', 'grays', 'central')
 
-FINAL_HTML = '''
+# The page is written in pieces: HEAD_HTML, agencies' tables, and TAIL_HTML
+HEAD_HTML = '''
 <!DOCTYPE html>
 <html lang="en">
   <head>
     <meta charset="UTF-8">
-    <link href="index.css" rel="stylesheet" type="text/css"/>
-    <link rel="icon" href="icon.ico">
+    <link href="%s" rel="stylesheet" type="text/css"/>
+    <link rel="icon" href="%s">
     <title>ManyBusesAway</title>
   </head>
   <body>
     <h1>Completed Buses</h1>
     %s
-%s
+'''
+TAIL_HTML = '''
     <p>%s</p>
-    <span class="credit" onclick="window.open(\'%s\', \'_blank\')">%s</span>
+    <span class="credit" onclick="window.open(\'%s\', \'_blank\')">%s</span>%s
   </body>
 </html>'''
+FINAL_HTML = HEAD_HTML + '%s' + TAIL_HTML
 
 NOTES = '''
 Routes with <span class="discontinued">Discontinued</span> tag have been
@@ -46,6 +68,33 @@ Routes with <span class="delisted">Delisted</span> tag remain operational
  but are absent from public transit agency websites (possibly intentionally).<br>
 See project homepage for details:'''
 
+# With compact HTML, this one handler opens every table cell's link (see
+# routes.td); links opening in new tabs follow their table's prefix
+COMPACT_SCRIPT = '''
+    <script>
+      document.addEventListener('click', function(e) {
+        var td = e.target.closest('td[data-l], td[data-s]');
+        if (!td) return;
+        if (td.dataset.s) window.open(td.dataset.s, '_self');
+        else window.open(td.closest('table').dataset.p + td.dataset.l);
+      });
+    </script>'''
+
+# Static assets referred to by FINAL_HTML
+CSS_FILENAME = 'index.css'
+# Written from CSS_FILENAME and used instead when minifying
+MIN_CSS_FILENAME = 'index.min.css'
+ICON_FILENAME = 'icon.ico'
+# Seconds between refreshes of each agency when serving, unless specified
+REFRESH_INTERVAL = 3600
+STALE_MSG = 'Could not get every resource for %s, keeping its previous table'
+SNAPSHOT_SKIP_MSG = 'Could not get every resource for %s, leaving it out of'\
+    + ' the snapshot'
+REBUILD_ERROR_MSG = 'Could not rebuild %s, still watching: %s'
+
+# Subdirectory of the cache directory for agencies' tables (see fragments.py)
+FRAGMENTS_SUBDIR = 'fragments'
+
 def parse_args():
     '''
     This function uses an argparse.ArgumentParser to parse arguments.
@@ -68,13 +117,161 @@ def parse_args():
         '--images',
         type=str,
         help='relative path to root directory for images')
+    parser.add_argument(
+        '-t',
+        '--thumbnails',
+        type=str,
+        help='relative path to directory for thumbnails of images (needs -i)')
+    parser.add_argument(
+        '--hash-assets',
+        type=str,
+        metavar='DIR',
+        help='relative path to directory to publish content-hashed assets to')
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='give links in data attributes, for smaller HTML')
+    parser.add_argument(
+        '-m',
+        '--minify',
+        action='store_true',
+        help='minify the HTML, and the stylesheet into %s' % MIN_CSS_FILENAME)
+    parser.add_argument(
+        '-z',
+        '--precompress',
+        action='store_true',
+        help='also write .gz (and .br) copies of the HTML and stylesheet')
+    parser.add_argument(
+        '--jsonl',
+        type=str,
+        metavar='FILE',
+        help='also export route listings as JSON Lines')
+    parser.add_argument(
+        '--csv',
+        type=str,
+        metavar='FILE',
+        help='also export route listings as CSV')
+    parser.add_argument(
+        '--snapshot-db',
+        type=str,
+        metavar='FILE',
+        help='record route listings in a database (see snapshots.py)')
+    parser.add_argument(
+        '--no-html',
+        action='store_true',
+        help='only export route listings (needs --jsonl or --csv)')
+    parser.add_argument(
+        '-c',
+        '--cache',
+        type=str,
+        help='directory in which to cache responses between runs')
+    parser.add_argument(
+        '--max-connections',
+        type=int,
+        default=MAX_CONNECTIONS,
+        help='maximum number of requests in flight at once')
+    parser.add_argument(
+        '--per-host',
+        type=int,
+        default=MAX_PER_HOST,
+        help='maximum number of requests in flight to any one website')
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=0,
+        help='maximum requests started per second to any one website')
+    parser.add_argument(
+        '--connect-timeout',
+        type=float,
+        default=CONNECT_TIMEOUT,
+        help='seconds allowed to connect to a website')
+    parser.add_argument(
+        '--read-timeout',
+        type=float,
+        default=READ_TIMEOUT,
+        help='seconds allowed for any one read from a website')
+    parser.add_argument(
+        '--deadline',
+        type=float,
+        default=DEADLINE,
+        help='seconds allowed for each request as a whole')
+    parser.add_argument(
+        '--hedge',
+        type=float,
+        metavar='PERCENTILE',
+        help='duplicate requests slower than this latency percentile')
+    parser.add_argument(
+        '-w',
+        '--watch',
+        action='store_true',
+        help='rebuild whenever images change, without new requests (needs -i)')
+    parser.add_argument(
+        '--serve',
+        type=int,
+        metavar='PORT',
+        help='serve the page locally, refreshing agencies in the background')
+    parser.add_argument(
+        '--refresh',
+        type=float,
+        default=REFRESH_INTERVAL,
+        metavar='SECONDS',
+        help='seconds between refreshes of each agency when serving')
+    parser.add_argument(
+        '--refresh-agency',
+        action='append',
+        default=[],
+        metavar='AGENCY=SECONDS',
+        help='seconds between refreshes of one agency when serving')
+    record_replay = parser.add_mutually_exclusive_group()
+    record_replay.add_argument(
+        '--record',
+        type=str,
+        metavar='DIR',
+        help='record all responses from websites into a directory')
+    record_replay.add_argument(
+        '--replay',
+        type=str,
+        metavar='DIR',
+        help='use responses recorded in a directory instead of websites')
+    parser.add_argument(
+        '--trace',
+        type=str,
+        metavar='FILE',
+        help='write a trace of the build, for Perfetto or chrome://tracing')
     parser.add_argument(
         'agencies',
         nargs='*',
         type=str,
         default=DEFAULT_AGENCIES_ORDER,
         help='specify agencies to use and their order of appearance')
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.max_connections < 1 or args.per_host < 1:
+        parser.error('--max-connections and --per-host must be at least 1')
+    if args.hedge is not None and not 0 < args.hedge <= 100:
+        parser.error('--hedge must be a percentile above 0 and at most 100')
+    if args.watch and not args.images:
+        parser.error('--watch needs -i')
+    if args.no_html and not (args.jsonl or args.csv):
+        parser.error('--no-html needs --jsonl or --csv')
+    if args.serve is not None and (args.watch or args.no_html):
+        parser.error('--serve cannot be used with --watch or --no-html')
+    # Published copies mustn't be mixed up with (or replace) their originals
+    if args.hash_assets and any(assets.contains(args.hash_assets, p)
+            for p in (os.curdir, args.images) if p):
+        parser.error('--hash-assets cannot be or contain the current or'
+            ' image directory')
+    if args.hash_assets and not assets.inside(args.images or os.curdir):
+        parser.error('--hash-assets needs -i to be a relative path within the'
+            ' current directory')
+    # Each agency's refresh interval, where they're given
+    args.intervals = dict()
+    for option in args.refresh_agency:
+        agency, equals, seconds = option.partition('=')
+        try:
+            args.intervals[agency] = float(seconds)
+        except ValueError:
+            parser.error('--refresh-agency needs AGENCY=SECONDS')
+    return args
 
 def completenessHTML(data_parsers):
     '''
@@ -93,6 +290,285 @@ def completenessHTML(data_parsers):
         return '<h2>Fully Complete on %s</h2>' % dt
     return '<h2>%d%% Complete, Updated %s</h2>' % (completed * 100 // total, dt)
 
+def build_parser(route_module, agency, args, futures, stage=None,
+        fragments=None):
+    '''
+    Constructs and returns the DataParser from route_module for string
+    agency, which scans its images (if any) while requests are still being
+    performed, and submits it to thumbnails.ThumbnailStage stage if given.
+    Then waits for the resources it requires from dictionary futures (of
+    requests to concurrent.futures.Futures), and updates it and sanitizes its
+    strings, unless fragments.FragmentCache fragments already has its HTML
+    from these same inputs.
+    '''
+    if args.images:
+        # Each DataParser is constructed with its image directory
+        # This will automatically create RouteListings for each image it has
+        data_parser = route_module.DataParser(agency, args.verbose, args.images)
+        if stage:
+            stage.submit(data_parser)
+    else:
+        # Construct DataParser with no image directory
+        data_parser = route_module.DataParser(agency, args.verbose)
+    # When tracing, this shows how long each agency waited on websites
+    with tracing.span('resources', 'build', agency=agency):
+        resources = {
+            r: futures[r].result() for r in data_parser.INITIAL_REQUESTS}
+    data_parser.complete = all(v is not None for v in resources.values())
+    if fragments and data_parser.CACHE_FRAGMENTS:
+        # Anything else which changes the HTML is an option here
+        options = (args.images, args.thumbnails,
+            stage.formats if stage else (), args.hash_assets, args.compact)
+        data_parser.fragment_key = fragments.key(
+            data_parser, resources, options)
+        data_parser.fragment = fragments.load(agency, data_parser.fragment_key)
+        if data_parser.fragment:
+            if args.verbose:
+                print('Using cached %s table' % agency)
+            return data_parser
+    with tracing.span('update', 'build', agency=agency) as trace_args:
+        data_parser.update(resources)
+        trace_args['routes'] = len(data_parser.routelistings)
+    with tracing.span('sanitize_strings', 'build', agency=agency):
+        data_parser.sanitize_strings()
+    return data_parser
+
+def render_tables(data_parsers, fragments=None, compact=False):
+    '''
+    Generates the HTML generated by each of DataParsers data_parsers
+    (compact if compact is True), one at a time, storing any which wasn't
+    cached in fragments.FragmentCache fragments, if given.
+    '''
+    for d in data_parsers:
+        with tracing.span('to_html', 'build', agency=d.agency,
+                cached=bool(d.fragment)):
+            table = d.to_html(compact)
+        if fragments and d.fragment_key and not d.fragment:
+            fragments.store(d.agency, d.fragment_key, table, d.completed())
+        yield table
+
+def publish_assets(directory, data_parsers, stylesheet=CSS_FILENAME,
+        verbose=False):
+    '''
+    Publishes all images of DataParsers data_parsers, along with string
+    stylesheet (a path) and the icon, under content-hashed names in string
+    directory (see assets.py), so that routes.asset_url gives their published
+    paths.
+    '''
+    if verbose:
+        print('Publishing assets to %s...' % directory)
+    # Image digests are already known from DataParsers' image indexes
+    asset_list = [(stylesheet, None), (ICON_FILENAME, None)]
+    for d in data_parsers:
+        if d.image_index:
+            asset_list.extend(
+                (os.path.join(d.image_dir, name), entry.digest)
+                for name, entry in d.image_index.entries.items())
+    routes.ASSET_URLS.update(assets.publish(directory, asset_list))
+
+def prepare_stylesheet(args):
+    '''
+    Returns the path of the stylesheet to use, which is a minified copy of
+    it if args.minify is set (see output.py).
+    '''
+    if not args.minify:
+        return CSS_FILENAME
+    output.write_minified_css(CSS_FILENAME, MIN_CSS_FILENAME)
+    return MIN_CSS_FILENAME
+
+def html_pieces(args, data_parsers, tables, stylesheet=CSS_FILENAME):
+    '''
+    Generates the final HTML in pieces, from DataParsers data_parsers and
+    iterable tables of the HTML each generated (which may be a generator, so
+    only one table need be in memory at once), linking to string stylesheet,
+    with the script needed to open links if args.compact is set.
+    '''
+    yield HEAD_HTML % (
+        routes.asset_url(stylesheet),
+        routes.asset_url(ICON_FILENAME),
+        completenessHTML(data_parsers))
+    for i, table in enumerate(tables):
+        # Tables are separated by newlines
+        yield '\n' + table if i else table
+    yield TAIL_HTML % (
+        NOTES,
+        'https://github.com/6exagon/manybusesaway',
+        re.search(r'([^\s]*\sv\d\.\d\..*)\s', __doc__).group(1),
+        COMPACT_SCRIPT if args.compact else '')
+
+def write_html(args, data_parsers, tables, stylesheet=CSS_FILENAME):
+    '''
+    Writes the final HTML to args.output, as generated by html_pieces from
+    the same arguments, minifying it if args.minify is set. The file is only
+    replaced (atomically) if its contents changed, so that an unchanged page
+    isn't uploaded again.
+    Then precompresses the HTML and the stylesheet if args.precompress is
+    set.
+    '''
+    if args.verbose:
+        print('Writing to %s...' % args.output)
+    pieces = html_pieces(args, data_parsers, tables, stylesheet)
+    if args.minify:
+        pieces = output.minify_html_pieces(pieces)
+    # Tables are generated as they're written, so this includes to_html
+    with tracing.span('write', 'build', path=args.output) as trace_args:
+        trace_args['replaced'] = atomic.write_stream(args.output, pieces)
+    if not trace_args['replaced'] and args.verbose:
+        print('%s is unchanged' % args.output)
+    if args.precompress:
+        if args.verbose:
+            print('Precompressing...')
+        output.precompress(args.output)
+        output.precompress(routes.asset_url(stylesheet))
+
+def export_data(args, data_parsers):
+    '''
+    Exports the route listings of DataParsers data_parsers, in order, to
+    args.jsonl as JSON Lines and to args.csv as CSV, if either is set (see
+    output.py). Rows are generated as they're written.
+    '''
+    for path, write in ((args.jsonl, output.write_jsonl),
+            (args.csv, lambda p, rows: output.write_csv(
+                p, routes.EXPORT_FIELDS, rows))):
+        if not path:
+            continue
+        if args.verbose:
+            print('Exporting to %s...' % path)
+        write(path, (row for d in data_parsers for row in d.export_rows()))
+
+def record_snapshot(args, data_parsers):
+    '''
+    Records the route listings of DataParsers data_parsers in the snapshot
+    database at args.snapshot_db (see snapshots.py). Agencies which couldn't
+    get every resource are left out of the build, so that their routes
+    aren't reported as changed or removed; no build is recorded if none
+    could.
+    '''
+    complete = [d for d in data_parsers if d.complete]
+    for d in data_parsers:
+        if not d.complete:
+            print(SNAPSHOT_SKIP_MSG % d.agency, file=stderr)
+    if not complete:
+        return
+    build = snapshots.record(args.snapshot_db, [d.agency for d in complete],
+        (row for d in complete for row in d.export_rows()))
+    if args.verbose:
+        print('Recorded build %d in %s' % (build, args.snapshot_db))
+
+def watch_images(args, route_modules, futures, data_parsers, tables,
+        stage=None, fragments=None, stylesheet=CSS_FILENAME):
+    '''
+    Rebuilds the output file whenever images change, until interrupted.
+    Only the DataParsers of agencies whose images changed are reconstructed,
+    and they're updated from the same resources as before, so nothing is
+    requested again (requests made by DataParsers themselves are memoized).
+    A rebuild which fails is reported to stderr, and watching continues.
+    Arguments are as in main(), where lists data_parsers and tables are
+    what was built for each agency, and thumbnails.ThumbnailStage stage (if
+    given) is reused for every rebuild.
+    '''
+    watcher = Watcher(args.images, args.agencies)
+    print('Watching %s for changes...' % args.images)
+    try:
+        while True:
+            changed = watcher.wait()
+            start = time()
+            try:
+                rebuild(args, route_modules, futures, data_parsers, tables,
+                    changed, stage, fragments, stylesheet)
+            except Exception as e:
+                print(REBUILD_ERROR_MSG % (', '.join(sorted(changed)),
+                    str(e) or type(e).__name__), file=stderr)
+                continue
+            print('Rebuilt %s in %.3f seconds' % (
+                ', '.join(sorted(changed)), time() - start))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def rebuild(args, route_modules, futures, data_parsers, tables, changed,
+        stage=None, fragments=None, stylesheet=CSS_FILENAME):
+    '''
+    Rebuilds the output file for watch_images after the images of agencies
+    in set changed have changed, replacing their items in lists data_parsers
+    and tables. Other arguments are as for watch_images.
+    '''
+    for i, agency in enumerate(args.agencies):
+        if agency not in changed:
+            continue
+        data_parsers[i] = build_parser(
+            route_modules[i], agency, args, futures, stage, fragments)
+        if stage:
+            stage.finish()
+    if args.hash_assets:
+        publish_assets(
+            args.hash_assets, data_parsers, stylesheet, args.verbose)
+    if not args.no_html:
+        for i, agency in enumerate(args.agencies):
+            if agency in changed:
+                tables[i] = next(render_tables(
+                    [data_parsers[i]], fragments, args.compact))
+        write_html(args, data_parsers, tables, stylesheet)
+    export_data(args, data_parsers)
+
+def serve_page(args, route_modules, data_parsers, fragments=None,
+        stylesheet=CSS_FILENAME):
+    '''
+    Serves the page from memory on port args.serve until interrupted (see
+    serve.py), refreshing each agency in the background every args.refresh
+    seconds (or as given in args.intervals). A refreshed agency's table
+    replaces its previous one only if every resource it needs was gotten;
+    otherwise, the stale table stays until the next refresh.
+    Other arguments are as in main(), where list data_parsers is what was
+    built for each agency.
+    '''
+    tables = list(render_tables(data_parsers, fragments, args.compact))
+    site = Site('/' + os.path.basename(args.output))
+    lock = threading.Lock()
+
+    def render():
+        pieces = html_pieces(args, data_parsers, tables, stylesheet)
+        if args.minify:
+            pieces = output.minify_html_pieces(pieces)
+        site.set_page(''.join(pieces))
+
+    def refresher(i, agency):
+        def refresh():
+            if args.verbose:
+                print('Refreshing %s...' % agency)
+            futures = prefetch(
+                route_modules[i].DataParser.INITIAL_REQUESTS, args.verbose)
+            if any(f.result() is None for f in futures.values()):
+                print(STALE_MSG % agency, file=stderr)
+                return
+            stage = None
+            if args.thumbnails:
+                stage = ThumbnailStage(args.thumbnails, args.verbose)
+            data_parser = build_parser(
+                route_modules[i], agency, args, futures, stage, fragments)
+            if stage:
+                stage.finish()
+                stage.close()
+            with lock:
+                data_parsers[i] = data_parser
+                if args.hash_assets:
+                    publish_assets(args.hash_assets, data_parsers,
+                        stylesheet, args.verbose)
+                tables[i] = next(
+                    render_tables([data_parser], fragments, args.compact))
+                render()
+        return refresh
+
+    render()
+    stop = threading.Event()
+    refreshers = [Refresher(agency, args.intervals.get(agency, args.refresh),
+        refresher(i, agency), stop) for i, agency in enumerate(args.agencies)]
+    # Only what the page can refer to is served
+    paths = [routes.asset_url(stylesheet), routes.asset_url(ICON_FILENAME)]
+    paths.extend(filter(None, (args.images, args.thumbnails, args.hash_assets)))
+    serve(args.serve, site, refreshers, paths, verbose=args.verbose)
+
 def main():
     '''
     Entry point of program.
@@ -101,44 +577,71 @@ def main():
     # This is necessary for time formatting
     locale.setlocale(locale.LC_TIME, 'en_US')
     args = parse_args()
-    # For each agency requested, import its module and create its DataParser
+    if args.trace:
+        # Written however the program ends, including watch or serve mode
+        tracing.enable()
+        atexit.register(tracing.write, args.trace)
+    configure(args.cache, args.max_connections, args.per_host, args.rate,
+        args.connect_timeout, args.read_timeout, args.deadline, args.hedge,
+        args.record, args.replay, args.watch)
+    # For each agency requested, import its module
     route_modules = tuple(import_module('routes.' + m) for m in args.agencies)
-    if args.images:
-        # Each DataParser is constructed with its image directory
-        # This will automatically create RouteListings for each image it has
-        data_parsers = tuple(
-            route_modules[i].DataParser(a, args.verbose, args.images)
-            for i, a in enumerate(args.agencies))
-    else:
-        # Construct DataParsers with no image directory
-        data_parsers = tuple(
-            route_modules[i].DataParser(a, args.verbose)
-            for i, a in enumerate(args.agencies))
-
     # For each module, get requests it wants performed; see
     # DataParser.INITIAL_REQUESTS documentation
     # Thus, sets should all be unioned
-    # They need to be put into a list, though, for the ordering
-    initial_requests = list(
-        set().union(*(d.INITIAL_REQUESTS for d in data_parsers)))
-    # Perform the requests, then turn that into the resources dictionary
-    initial_resources = dict(
-        zip(initial_requests, request_all(initial_requests, args.verbose)))
-    for d in data_parsers:
-        d.update(initial_resources)
-        d.sanitize_strings()
+    # These are class attributes, so requests (and their DNS lookups and
+    # handshakes) start before any DataParser scans its images
+    futures = prefetch(
+        set().union(*(m.DataParser.INITIAL_REQUESTS for m in route_modules)),
+        args.verbose)
+    # Unchanged agencies' tables are kept with the response cache, if any
+    # Exports need every DataParser updated, so they can't use these
+    fragments = None
+    if requests.CACHE_DIR and not (args.jsonl or args.csv or args.snapshot_db):
+        fragments = FragmentCache(
+            os.path.join(requests.CACHE_DIR, FRAGMENTS_SUBDIR))
+    # Thumbnails are derived by other processes throughout the build
+    stage = None
+    if args.images and args.thumbnails:
+        stage = ThumbnailStage(args.thumbnails, args.verbose)
+    # Rather than waiting for every request, each DataParser is constructed
+    # right away and updated as soon as its own resources arrive, and any
+    # requests it makes itself overlap with other DataParsers' work
+    with ThreadPoolExecutor(len(route_modules)) as executor:
+        # Iterating over the results raises any exception from a DataParser
+        data_parsers = list(executor.map(build_parser, route_modules,
+            args.agencies, repeat(args), repeat(futures), repeat(stage),
+            repeat(fragments)))
+    if stage:
+        stage.finish()
+        # Watch mode keeps using the same worker processes
+        if not args.watch:
+            stage.close()
+    stylesheet = prepare_stylesheet(args)
+    if args.hash_assets:
+        publish_assets(
+            args.hash_assets, data_parsers, stylesheet, args.verbose)
 
-    if args.verbose:
-        print('Writing to %s...' % args.output)
-    with open(args.output, 'w') as fp:
-        fp.write(FINAL_HTML % (
-            completenessHTML(data_parsers),
-            '\n'.join([d.to_html() for d in data_parsers]),
-            NOTES,
-            'https://github.com/6exagon/manybusesaway',
-            re.search(r'([^\s]*\sv\d\.\d\..*)\s', __doc__).group(1)))
+    export_data(args, data_parsers)
+    if args.snapshot_db:
+        record_snapshot(args, data_parsers)
+    if args.serve is not None:
+        serve_page(args, route_modules, data_parsers, fragments, stylesheet)
+        return
+    tables = []
+    if not args.no_html:
+        tables = render_tables(data_parsers, fragments, args.compact)
+        if args.watch:
+            # Watch mode replaces tables one at a time, so it needs them all
+            tables = list(tables)
+        write_html(args, data_parsers, tables, stylesheet)
     if args.verbose:
         print('Done')
+    if args.watch:
+        watch_images(args, route_modules, futures, data_parsers, tables,
+            stage, fragments, stylesheet)
+        if stage:
+            stage.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,136 @@
+'''
+Writes output files (atomically, and only if they've changed; see
+atomic.py), including machine-readable exports of route listings (as JSON
+Lines and CSV), and post-processes them: minifies the generated HTML and
+the stylesheet, and writes precompressed copies of them alongside (.gz, and
+.br if the third-party brotli module is installed), which static hosts can
+serve as they are instead of compressing every response.
+Precompressed files are deterministic, so they only change when their
+originals do.
+'''
+
+import csv
+import gzip
+import io
+from json import dumps
+import os
+import re
+
+from atomic import write_if_changed, write_stream
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Whitespace between tags, and indentation of lines
+# Whitespace between text and tags is kept, as it would be displayed
+HTML_SPACE = re.compile(r'>\s+<|^[ \t]+', re.M)
+# Strings are matched first so that they're kept exactly, and runs of
+# comments and whitespace become single spaces
+CSS_TOKENS = re.compile(
+    r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(?:/\*.*?\*/|\s)+', re.S)
+# Spaces before colons are kept, since they can be descendant combinators
+CSS_PUNCTUATION = re.compile(
+    r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')| ?([{};,>]) ?|(:) ')
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+def minify_html(html):
+    '''
+    Returns string html with whitespace removed between tags and from the
+    start of every line. Line breaks are kept, so that scripts needn't be
+    parsed. This is only meant for HTML like this program's, which has no
+    <pre> or <textarea> elements.
+    '''
+    return ''.join(minify_html_pieces((html,)))
+
+def minify_html_pieces(pieces):
+    '''
+    Generates the strings of HTML in iterable pieces, minified as by
+    minify_html, as if they were one string.
+    '''
+    # The end of each piece is held back (from its last non-whitespace
+    # character), since whitespace there may precede a tag in the next
+    held = ''
+    first = True
+    for piece in pieces:
+        piece = HTML_SPACE.sub(
+            lambda m: '><' if m.group().startswith('>') else '', held + piece)
+        if first:
+            piece = piece.lstrip()
+            first = False
+        end = max(len(piece.rstrip()) - 1, 0)
+        held = piece[end:]
+        if end:
+            yield piece[:end]
+    yield held.rstrip() + '\n'
+
+def minify_css(css):
+    '''
+    Returns string css with comments and unnecessary whitespace removed, and
+    without the last semicolon of each block.
+    '''
+    css = CSS_TOKENS.sub(lambda m: m.group(1) or ' ', css)
+    css = CSS_PUNCTUATION.sub(
+        lambda m: ''.join(filter(None, m.groups())), css)
+    return css.replace(';}', '}').strip() + '\n'
+
+def write_jsonl(path, rows):
+    '''
+    Writes iterable rows (dictionaries) to string path as JSON Lines, as
+    write_stream does, returning whether the file was replaced.
+    '''
+    return write_stream(
+        path, (dumps(row, ensure_ascii=False) + '\n' for row in rows))
+
+def write_csv(path, fields, rows):
+    '''
+    Writes iterable rows (dictionaries whose keys are the strings in
+    sequence fields) to string path as CSV with a header row, as
+    write_stream does, returning whether the file was replaced.
+    '''
+    return write_stream(path, csv_lines(fields, rows))
+
+def csv_lines(fields, rows):
+    '''
+    Generates the lines of CSV for write_csv, one row at a time.
+    '''
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fields)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def write_minified_css(source, destination):
+    '''
+    Writes the stylesheet at string path source, minified, to string path
+    destination, unless it's already up to date.
+    '''
+    if os.path.exists(destination) and (os.stat(destination).st_mtime_ns
+            >= os.stat(source).st_mtime_ns):
+        return
+    with open(source) as fp:
+        css = minify_css(fp.read())
+    write_if_changed(destination, css.encode())
+
+def precompress(path):
+    '''
+    Writes gzip (and, if possible, brotli) compressed copies of the file at
+    string path beside it, at maximum compression, with ".gz" and ".br"
+    appended to its name. The gzip header has no name or modification time,
+    so the same file always compresses to the same bytes. Any .br copy is
+    removed if brotli isn't installed, rather than left stale.
+    '''
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    write_if_changed(path + '.gz', gzip.compress(data, GZIP_LEVEL, mtime=0))
+    if brotli:
+        write_if_changed(
+            path + '.br', brotli.compress(data, quality=BROTLI_QUALITY))
+    elif os.path.exists(path + '.br'):
+        os.remove(path + '.br')
@@ -2,22 +2,629 @@
 Handles fetching resources from different sources concurrently by HTTPS.
 '''
 
+from abc import ABC, abstractmethod
+import bisect
+import codecs
 import http.client
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from hashlib import sha256
 from itertools import repeat
+from json import dumps, loads
+import os
+import socket
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep
+from urllib.parse import urlsplit
 from sys import stderr
+import zlib
 
-HEADERS = {'User-Agent': 'ManyBusesAway', 'Content-Type': 'application/json'}
+from atomic import temp_path, write_if_changed
+import tracing
+
+HEADERS = {
+    'User-Agent': 'ManyBusesAway',
+    'Content-Type': 'application/json',
+    'Connection': 'keep-alive',
+    'Accept-Encoding': 'gzip, deflate'}
 # For verbose printing, or in case of failure
 V_MSG = 'HTTPS request for %s%s got response %s'
+# Idle connections kept open per DNS name; more than this are simply closed
+MAX_IDLE_PER_HOST = 8
+# Compressed bodies are read and decompressed this many bytes at a time
+CHUNK_SIZE = 65536
+# Longest match PatternRequests allow for by default, in characters
+MAX_MATCH_LENGTH = 4096
+# Defaults for Scheduler, overridable by configure()
+MAX_CONNECTIONS = 16
+MAX_PER_HOST = 4
+# Defaults in seconds for connecting, for each read from a connection, and for
+# each request as a whole, overridable by configure()
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+DEADLINE = 90
+# Hedger only sends duplicate requests once it has this many latencies to go on
+MIN_HEDGE_SAMPLES = 8
+# Network failures which cause a request to give up and return None
+NETWORK_ERRORS = (OSError, http.client.HTTPException, zlib.error)
+
+class Connection(http.client.HTTPSConnection):
+    '''
+    http.client.HTTPSConnection with separate connect and read timeouts, and
+    the ability to shorten the read timeout to meet a deadline.
+    When tracing, connecting is traced as its DNS lookup, TCP connection, and
+    TLS handshake (see tracing.py).
+    '''
+    def __init__(self, dns_name, connect_timeout=CONNECT_TIMEOUT,
+            read_timeout=READ_TIMEOUT):
+        super().__init__(dns_name, timeout=connect_timeout)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = None
+        # When the TCP connection was made, so the TLS handshake can be traced
+        self.connected_at = None
+        if tracing.enabled():
+            self._create_connection = self.create_connection
+
+    def connect(self):
+        with tracing.span('connect', 'network', host=self.host):
+            super().connect()
+            if self.connected_at:
+                # Everything since connecting was the TLS handshake
+                tracing.add('TLS', 'network', self.connected_at, host=self.host)
+        self.limit(self.deadline)
+
+    def create_connection(self, address, timeout, source_address=None):
+        '''
+        Connects to tuple address as socket.create_connection does, but looks
+        up its addresses first, so that this and connecting are traced
+        separately.
+        '''
+        host, port = address
+        with tracing.span('DNS', 'network', host=host):
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        error = None
+        with tracing.span('TCP', 'network', host=host):
+            # Each address is tried in turn, as socket.create_connection does
+            for family, type, proto, name, sockaddr in addresses:
+                try:
+                    sock = socket.create_connection(
+                        sockaddr[:2], timeout, source_address)
+                    break
+                except OSError as e:
+                    error = e
+            else:
+                raise error
+        self.connected_at = tracing.now()
+        return sock
+
+    def limit(self, deadline):
+        '''
+        Limits the time any one operation on this connection may take so that
+        it finishes by float deadline (compared to time.monotonic()), or
+        removes any such limit if deadline is None.
+        Raises TimeoutError if deadline has already passed.
+        '''
+        self.deadline = deadline
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+        if deadline:
+            left = deadline - monotonic()
+            if left <= 0:
+                raise TimeoutError('deadline exceeded')
+            connect_timeout = min(connect_timeout, left)
+            read_timeout = min(read_timeout, left)
+        if self.sock:
+            self.sock.settimeout(read_timeout)
+        else:
+            self.timeout = connect_timeout
+
+class CustomRequest(ABC):
+    '''
+    Base class for requests which can't be described by a URL and optional
+    body alone, such as those requiring several dependent round trips or
+    signed headers. Instances (which must be hashable) can be used wherever
+    ordinary requests can, including DataParser.INITIAL_REQUESTS, so they are
+    performed in parallel with all other requests.
+    '''
+    @abstractmethod
+    def perform(self, verbose=False):
+        '''
+        Performs this request, preferably through exchange() so that pooled
+        connections, timeouts, and recording apply.
+        Returns the resulting resource, usually as a string (but anything the
+        DataParsers using it expect), or None on failure, in which case a
+        message should be printed to stderr.
+        If verbose is True, prints messages to stdout.
+        '''
+        pass
+
+class PatternRequest(CustomRequest):
+    '''
+    GET request for string url (a URI preceded by a DNS name) whose body is
+    matched against compiled regular expression pattern as it downloads,
+    so that matching overlaps the download and the whole body is never in
+    memory at once. Performing it results in a list of tuples of the groups
+    of each match, as from pattern.finditer on the whole body.
+    No match may be longer than integer max_length characters.
+    '''
+    def __init__(self, url, pattern, max_length=MAX_MATCH_LENGTH):
+        self.url = url
+        self.pattern = pattern
+        self.max_length = max_length
+
+    def __eq__(self, other):
+        return isinstance(other, PatternRequest) and (self.url, self.pattern)\
+            == (other.url, other.pattern)
+
+    def __hash__(self):
+        return hash((self.url, self.pattern))
+
+    def perform(self, verbose=False):
+        matcher = IncrementalMatcher(self.pattern, self.max_length)
+        dns_name, slash, page = self.url.partition('/')
+        try:
+            body = send(dns_name, slash + page, None, verbose, deadline(),
+                BodySink(matcher.feed))
+        except NETWORK_ERRORS as e:
+            print(V_MSG % (dns_name, slash + page, str(e) or
+                type(e).__name__), file=stderr)
+            return None
+        if body is None:
+            return None
+        return matcher.close()
+
+class IncrementalMatcher:
+    '''
+    Finds the matches of compiled regular expression pattern in UTF-8 text
+    given to feed() as bytes a chunk at a time, exactly as they would be
+    found in the whole text, given that no match is longer than integer
+    max_length characters. Only the text which could still be part of a
+    match is kept: at most the last chunk and max_length more characters.
+    '''
+    def __init__(self, pattern, max_length=MAX_MATCH_LENGTH):
+        self.pattern = pattern
+        self.max_length = max_length
+        # Characters split between chunks are held back by the decoder
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.matches = []
+
+    def feed(self, chunk):
+        '''Matches what's possible with bytes chunk added to the text.'''
+        self.text += self.decoder.decode(chunk)
+        self.scan(False)
+
+    def close(self):
+        '''
+        Matches the rest of the text, which is now complete, and returns a
+        list of tuples of the groups of every match.
+        '''
+        self.text += self.decoder.decode(b'', True)
+        self.scan(True)
+        return self.matches
+
+    def scan(self, final):
+        '''
+        Records matches in self.text which more text couldn't change, and
+        discards text before where the next match could start.
+        A match ending at least max_length characters before the end of the
+        text is complete, since no match could extend so far; likewise, no
+        match can start so far from the end and not have been found.
+        '''
+        limit = len(self.text) - self.max_length
+        end = 0
+        start = len(self.text)
+        for match in self.pattern.finditer(self.text):
+            if not final and match.end() > limit:
+                # This might be matched differently with more text
+                start = match.start()
+                break
+            self.matches.append(match.groups())
+            end = match.end()
+        self.text = self.text[max(end, min(start, limit)):]
+
+class BodySink:
+    '''
+    Receives the body of a streamed response (see send) a chunk at a time,
+    passing each (as bytes) to function consume as it arrives.
+    If string spool is set before the body arrives, it's also written to a
+    temporary file beside that path, which commit() moves into place, so
+    that it can be cached or recorded without being kept in memory.
+    '''
+    def __init__(self, consume):
+        self.consume = consume
+        self.spool = None
+        self.fp = None
+        self.temp = None
+        # Whether any of the body has been consumed, which can't be undone
+        self.started = False
+
+    def write(self, chunk):
+        '''Passes bytes chunk on, spooling it too if necessary.'''
+        if self.spool and not self.fp:
+            self.temp = temp_path(self.spool)
+            self.fp = open(self.temp, 'wb')
+        if self.fp:
+            self.fp.write(chunk)
+        self.started = True
+        self.consume(chunk)
+
+    def commit(self):
+        '''Moves the spooled body into place at self.spool.'''
+        if not self.fp:
+            write_if_changed(self.spool, b'')
+            return
+        self.fp.close()
+        self.fp = None
+        os.replace(self.temp, self.spool)
+
+    def discard(self):
+        '''Removes any spooled body, which won't be used.'''
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+            os.remove(self.temp)
+
+class Response:
+    '''
+    A response which has been read completely: integer status, dictionary
+    headers (with lowercase names), and bytes body (already decompressed).
+    Unlike http.client.HTTPResponse, this can be recorded and replayed.
+    '''
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name, default=None):
+        '''Returns the value of header string name, or default.'''
+        return self.headers.get(name.lower(), default)
+
+class ConnectionPool:
+    '''
+    Keeps idle keep-alive http.client.HTTPSConnections, keyed by DNS name, so
+    that repeated requests to the same website (including redirects and
+    requests made later by DataParsers themselves) reuse an existing TCP and
+    TLS session rather than performing a new handshake each time.
+    Connections are checked out with acquire() by one thread at a time, and
+    returned with release() once their response has been read completely.
+    '''
+    def __init__(self):
+        self.idle = dict()
+        self.lock = Lock()
+
+    def acquire(self, dns_name):
+        '''
+        Returns an idle connection to dns_name if there is one, or a new
+        (unconnected) Connection with the configured timeouts otherwise.
+        '''
+        with self.lock:
+            connections = self.idle.get(dns_name)
+            if connections:
+                return connections.pop()
+        return connection(dns_name)
+
+    def release(self, dns_name, conn):
+        '''
+        Returns conn, acquired for dns_name, to the pool for later reuse,
+        unless there are already enough idle connections for dns_name, in
+        which case it's closed.
+        '''
+        # conn.host has no port, so it can't be the key acquire() looks up
+        with self.lock:
+            connections = self.idle.setdefault(dns_name, [])
+            if len(connections) < MAX_IDLE_PER_HOST:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        '''Closes every idle connection; the pool may still be used after.'''
+        with self.lock:
+            idle, self.idle = self.idle, dict()
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+class ResponseCache:
+    '''
+    On-disk cache of response bodies along with their validators (ETag and
+    Last-Modified headers), used to make conditional requests so that an
+    unchanged resource costs a 304 response with no body.
+    Each entry is stored as two files named by a hash of the request method,
+    URL, and body (so POST requests are cached separately for each body):
+    a small JSON file of validators, and the raw response body.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, method, dns_name, page, body=None):
+        '''
+        Returns the path, without extension, of the entry for this request.
+        '''
+        key = sha256('\n'.join((method, dns_name + page, body or '')).encode())
+        return os.path.join(self.directory, key.hexdigest())
+
+    def validators(self, path):
+        '''
+        Returns a dictionary of conditional request headers for the entry at
+        path, which is empty if there is no usable entry.
+        '''
+        try:
+            with open(path + '.json') as fp:
+                meta = loads(fp.read())
+        except (OSError, ValueError):
+            return dict()
+        if not os.path.exists(path + '.body'):
+            return dict()
+        headers = dict()
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def load(self, path):
+        '''Returns the cached body at path as bytes, or None if missing.'''
+        try:
+            with open(path + '.body', 'rb') as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def open_body(self, path):
+        '''Returns the cached body at path as an open file, or None.'''
+        try:
+            return open(path + '.body', 'rb')
+        except OSError:
+            return None
+
+    def store(self, path, url, resp, sink=None):
+        '''
+        Stores the body of Response resp at path if resp has any validators;
+        otherwise removes any stale entry, since it could never be
+        revalidated.
+        If the body was streamed, BodySink sink has it spooled to path.
+        Files are replaced atomically, as other threads may be reading them.
+        '''
+        meta = {
+            'url': url,
+            'etag': resp.getheader('ETag'),
+            'last_modified': resp.getheader('Last-Modified')}
+        if not meta['etag'] and not meta['last_modified']:
+            if sink:
+                sink.discard()
+            for ext in ('.json', '.body'):
+                try:
+                    os.remove(path + ext)
+                except OSError:
+                    pass
+            return
+        # The body goes first, so metadata never refers to a missing body
+        if resp.body is None:
+            sink.commit()
+        else:
+            write_if_changed(path + '.body', resp.body)
+        write_if_changed(path + '.json', dumps(meta).encode())
+
+class Recorder:
+    '''
+    Records every exchange made with a website (status, headers, and body,
+    including redirects) into a directory, or replays exchanges previously
+    recorded there instead of using the network at all. This allows a whole
+    build to run offline and deterministically, for testing or benchmarking.
+    Each exchange is stored as two files named by a hash of its key, which
+    is by default the request method, URL, and body: a JSON file describing
+    the request and response, and the raw (decompressed) response body.
+    '''
+    def __init__(self, directory, replay=False):
+        self.directory = directory
+        self.replay = replay
+        # Total bytes of bodies replayed, for measuring throughput
+        self.loaded = 0
+        if not replay:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, method, url, body=None):
+        '''
+        Returns the path, without extension, of the exchange for this request.
+        '''
+        key = sha256('\n'.join((method, url, body or '')).encode())
+        return os.path.join(self.directory, key.hexdigest())
+
+    def load(self, path):
+        '''
+        Returns the Response recorded at path.
+        Raises FileNotFoundError (which is treated like any other network
+        error) if nothing was recorded for it.
+        '''
+        try:
+            with open(path + '.json') as fp:
+                meta = loads(fp.read())
+            with open(path + '.body', 'rb') as fp:
+                body = fp.read()
+        except FileNotFoundError:
+            raise FileNotFoundError('no recorded response')
+        self.loaded += len(body)
+        return Response(meta['status'], meta['headers'], body)
+
+    def store(self, path, method, url, body, resp, sink=None):
+        '''
+        Records Response resp to request method for url (with optional
+        string body) at path. If its body was streamed, BodySink sink has it
+        spooled to path.
+        '''
+        meta = {
+            'method': method,
+            'url': url,
+            'body': body,
+            'status': resp.status,
+            'headers': resp.headers}
+        if resp.body is None:
+            sink.commit()
+        else:
+            write_if_changed(path + '.body', resp.body)
+        write_if_changed(path + '.json', dumps(meta, indent=1).encode())
+
+class Scheduler:
+    '''
+    Bounds how many requests may be in flight at once, both in total and to
+    any one DNS name, and optionally how many requests per second may be
+    started to any one DNS name. Smaller agencies' servers are liable to
+    throttle or block clients which open too many connections at once.
+    '''
+    def __init__(self, max_total=MAX_CONNECTIONS, max_per_host=MAX_PER_HOST,
+            rate=0):
+        self.max_total = max_total
+        self.max_per_host = max_per_host
+        # Minimum seconds between request starts per DNS name, 0 for none
+        self.interval = 1 / rate if rate else 0
+        self.total = BoundedSemaphore(max_total)
+        # These are keyed by DNS name
+        self.hosts = dict()
+        self.next_start = dict()
+        self.lock = Lock()
+
+    @contextmanager
+    def slot(self, dns_name):
+        '''
+        Context manager which blocks until a request to dns_name may be made
+        within all limits, and holds its place until exited.
+        '''
+        with self.lock:
+            host = self.hosts.get(dns_name)
+            if not host:
+                host = BoundedSemaphore(self.max_per_host)
+                self.hosts[dns_name] = host
+        # The host is waited for first, and its rate limit after that, so that
+        # a request for a busy or throttled host doesn't hold up requests for
+        # others by taking a global slot
+        with host:
+            if self.interval:
+                with self.lock:
+                    now = monotonic()
+                    start = max(now, self.next_start.get(dns_name, now))
+                    self.next_start[dns_name] = start + self.interval
+                if start > now:
+                    sleep(start - now)
+            with self.total:
+                yield
+
+class Hedger:
+    '''
+    Runs requests such that, if one is taking longer than a given percentile
+    of the latencies seen so far, an identical request is sent alongside it
+    and whichever successfully responds first is used. This bounds the damage
+    one slow response from an agency's server can do to the whole build.
+    '''
+    def __init__(self, percentile, max_workers=MAX_CONNECTIONS):
+        self.percentile = percentile
+        # Kept sorted, so percentiles are simple to find
+        self.latencies = []
+        self.lock = Lock()
+        # Separate from any executor a request might be running in, since
+        # requests wait on these
+        self.executor = ThreadPoolExecutor(max_workers * 2)
+
+    def delay(self):
+        '''
+        Returns the number of seconds after which a request should be hedged,
+        or None if there aren't enough samples yet.
+        '''
+        with self.lock:
+            if len(self.latencies) < MIN_HEDGE_SAMPLES:
+                return None
+            i = round((len(self.latencies) - 1) * self.percentile / 100)
+            return self.latencies[i]
+
+    def run(self, function, *args):
+        '''
+        Returns function(*args), calling it a second time concurrently if the
+        first call takes too long. A result of None is considered a failure,
+        so the other call is waited for if it hasn't finished.
+        '''
+        start = monotonic()
+        delay = self.delay()
+        futures = {self.executor.submit(function, *args)}
+        if delay is not None:
+            done, _ = wait(futures, delay)
+            if not done:
+                futures.add(self.executor.submit(function, *args))
+        result = None
+        while futures and result is None:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.result() is not None:
+                    result = future.result()
+        if result is not None:
+            with self.lock:
+                bisect.insort(self.latencies, monotonic() - start)
+        return result
+
+# Shared by every call to request_all for the lifetime of the program
+POOL = ConnectionPool()
+SCHEDULER = Scheduler()
+# These are set by configure()
+CACHE = None
+# Directory in which other modules may keep small files between runs, if any
+CACHE_DIR = None
+HEDGER = None
+RECORDER = None
+TIMEOUTS = (CONNECT_TIMEOUT, READ_TIMEOUT, DEADLINE)
+# Dictionary of requests to what request_one returned for them, if memoizing
+MEMO = None
+
+def configure(cache_dir=None, max_connections=MAX_CONNECTIONS,
+        max_per_host=MAX_PER_HOST, rate=0, connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT, deadline=DEADLINE, hedge=None,
+        record_dir=None, replay_dir=None, memoize=False):
+    '''
+    Sets options for all requests made afterwards.
+    If string cache_dir is given, responses are cached in its http
+    subdirectory and revalidated with conditional requests.
+    Integers max_connections and max_per_host limit concurrent requests in
+    total and per DNS name, and number rate (if nonzero) limits requests
+    started per second per DNS name.
+    Numbers connect_timeout, read_timeout, and deadline are the seconds
+    allowed to connect, for any one read, and for a whole request including
+    redirects. If number hedge is given, GET requests slower than that
+    percentile of latencies so far are duplicated (see Hedger).
+    If string record_dir is given, all exchanges are recorded there; if
+    string replay_dir is given, exchanges recorded there are used instead of
+    the network. Either disables cache_dir, so that every recorded exchange
+    has its body and no replayed exchange depends on the cache.
+    If memoize is True, each request is only performed once, and later
+    requests for it get the same result from memory; this is for rebuilding
+    without the network, as in watch mode.
+    '''
+    global CACHE, CACHE_DIR, SCHEDULER, HEDGER, TIMEOUTS, RECORDER, MEMO
+    # Idle connections would otherwise keep the previous timeouts
+    POOL.close_all()
+    SCHEDULER = Scheduler(max_connections, max_per_host, rate)
+    TIMEOUTS = (connect_timeout, read_timeout, deadline)
+    HEDGER = Hedger(hedge, max_connections) if hedge else None
+    CACHE = None
+    CACHE_DIR = None
+    RECORDER = None
+    MEMO = dict() if memoize else None
+    if record_dir:
+        RECORDER = Recorder(record_dir)
+    elif replay_dir:
+        RECORDER = Recorder(replay_dir, replay=True)
+    elif cache_dir:
+        CACHE = ResponseCache(os.path.join(cache_dir, 'http'))
+        CACHE_DIR = cache_dir
 
 def request_all(request_list, verbose=False):
     '''
     This function takes a list whose contents are either strings (URIs
-    preceded by DNS names, i.e. website URLs) for GET requests, or tuples
-    containing a string URL and a request body for POST requests.
-    These are provided to http.client.HTTPSConnection.request. For speed,
-    requests from the same DNS name aren't sent over the same HTTPS connection.
+    preceded by DNS names, i.e. website URLs) for GET requests, tuples
+    containing a string URL and a request body for POST requests, or
+    CustomRequests, which perform themselves.
+    The first two are provided to http.client.HTTPSConnection.request.
+    Connections are kept alive in POOL and reused by later requests to the
+    same DNS name.
     Returns an iterable whose values are the response bodies, in the same order
     as the input.
     If a status code is anything other than 200, prints message to stderr and
@@ -25,58 +632,272 @@ def request_all(request_list, verbose=False):
     indicated location is requested.
     If verbose is True, prints all requests.
     '''
+    if not request_list:
+        return []
     # This function uses a concurrent.futures.ThreadPoolExecutor to handle
     # multiple HTTP requests at once
     # This isn't real multithreading in CPython due to the GIL, but this
     # doesn't matter
     # http.client is not compatible with asyncio, and third-party libraries
     # are not used
-    with ThreadPoolExecutor(len(request_list)) as executor:
+    # Threads beyond the global limit would only wait on SCHEDULER anyway
+    workers = min(len(request_list), SCHEDULER.max_total)
+    with ThreadPoolExecutor(workers) as executor:
         return executor.map(request_one, request_list, repeat(verbose))
 
+def prefetch(request_set, verbose=False):
+    '''
+    Starts performing every request in set request_set (each as described
+    for request_all) in the background, without waiting for any of them.
+    Returns a dictionary whose keys are the requests and whose values are
+    concurrent.futures.Futures, each resulting in what request_one returns.
+    '''
+    workers = max(1, min(len(request_set), SCHEDULER.max_total))
+    executor = ThreadPoolExecutor(workers)
+    futures = {r: executor.submit(request_one, r, verbose) for r in request_set}
+    # Already submitted requests will still be completed
+    executor.shutdown(wait=False)
+    return futures
+
 def request_one(url, verbose=False):
     '''
-    Returns one resource gotten from url (either a string or a tuple, as
-    described above).
-    Makes and closes one http.client.HTTPSConnection.
-    Returns None or the requested resource.
+    Returns one resource gotten from url (either a string, a tuple, or a
+    CustomRequest, as described above).
+    Returns None or the requested resource. Network errors and timeouts are
+    printed to stderr, resulting in None.
+    GET requests are hedged if configured (see Hedger).
+    If memoizing, failures are remembered too, so a rebuild never waits on a
+    website that already failed.
+    '''
+    if MEMO is None:
+        return perform(url, verbose)
+    if url not in MEMO:
+        # Concurrent duplicates are harmless, just wasteful
+        MEMO[url] = perform(url, verbose)
+    return MEMO[url]
+
+def perform(url, verbose=False):
+    '''
+    Performs one request as described for request_one, without memoizing.
     '''
+    if isinstance(url, CustomRequest):
+        return url.perform(verbose)
     body = None
     if not isinstance(url, str):
         # Usually just a string for GET requests, but was (url, body) for POST
         url, body = url
     dns_name, slash, p = url.partition('/')
-    connection = http.client.HTTPSConnection(dns_name)
-    returnval = send(connection, slash + p, body, verbose)
-    connection.close()
-    return returnval
+    if HEDGER and not body:
+        return HEDGER.run(fetch, dns_name, slash + p, body, verbose)
+    return fetch(dns_name, slash + p, body, verbose)
+
+def fetch(dns_name, page, body=None, verbose=False):
+    '''
+    Calls send() with a new deadline, handling network errors and timeouts
+    by printing a message to stderr and returning None.
+    '''
+    try:
+        return send(dns_name, page, body, verbose, deadline())
+    except NETWORK_ERRORS as e:
+        print(V_MSG % (dns_name, page, str(e) or type(e).__name__),
+            file=stderr)
+        return None
+
+def deadline():
+    '''
+    Returns the deadline, compared to time.monotonic(), for a request
+    starting now.
+    '''
+    return monotonic() + TIMEOUTS[2]
 
-def send(conn, page, body=None, verbose=False):
+def connection(dns_name):
     '''
-    Sends single request for string page (with optional body) over
-    http.client.HTTPSConnection conn.
+    Returns a new, unconnected Connection to dns_name with the configured
+    timeouts.
+    '''
+    return Connection(dns_name, TIMEOUTS[0], TIMEOUTS[1])
+
+def exchange(dns_name, method, page, body=None, headers=HEADERS,
+        deadline=None, key=None, sink=None):
+    '''
+    Performs a single HTTPS request/response round trip with dns_name over a
+    pooled connection, reading the whole response so the connection can be
+    reused. Waits for SCHEDULER to allow the request first.
+    Returns a Response.
+    If float deadline is given, raises TimeoutError if the response can't be
+    read by then (compared to time.monotonic()).
+    If RECORDER is set, the exchange is recorded or replayed; string key
+    should be given in place of page to identify it if page varies between
+    runs, as with a timestamp in its query.
+    A connection taken from the pool may have been closed by the server since
+    it was last used; in that case the request is retried once over a fresh
+    connection. Other network errors propagate.
+    If BodySink sink is given, the body of a 200 response is streamed to it
+    instead of being read into the Response, whose body is then None.
+    When tracing, waiting for SCHEDULER, connecting, waiting for the response
+    (TTFB), and reading its body are traced separately.
+    '''
+    if RECORDER:
+        record_path = RECORDER.path(method, dns_name + (key or page), body)
+        if RECORDER.replay:
+            resp = RECORDER.load(record_path)
+            if sink and resp.status == 200:
+                for i in range(0, len(resp.body), CHUNK_SIZE):
+                    sink.write(resp.body[i:i + CHUNK_SIZE])
+                resp.body = None
+            return resp
+        if sink:
+            sink.spool = record_path + '.body'
+    queued = tracing.now()
+    with SCHEDULER.slot(dns_name):
+        tracing.add('queued', 'network', queued, host=dns_name)
+        while True:
+            conn = POOL.acquire(dns_name)
+            # A connection that has never been used has no socket yet
+            reused = conn.sock is not None
+            try:
+                conn.limit(deadline)
+                if not reused:
+                    # Otherwise, request() would connect within TTFB
+                    conn.connect()
+                with tracing.span('TTFB', 'network', host=dns_name):
+                    conn.request(method, page, body, headers)
+                    resp = conn.getresponse()
+                with tracing.span(
+                        'download', 'network', host=dns_name) as trace_args:
+                    data = read_body(resp, conn, deadline,
+                        sink if resp.status == 200 else None)
+                    if data is not None:
+                        trace_args['bytes'] = len(data)
+                break
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                # A body partly streamed can't be streamed again
+                if not reused or (sink and sink.started):
+                    if sink:
+                        sink.discard()
+                    raise
+            except NETWORK_ERRORS:
+                # The connection is in an unknown state after a timeout
+                conn.close()
+                if sink:
+                    sink.discard()
+                raise
+    if resp.will_close:
+        conn.close()
+    else:
+        POOL.release(dns_name, conn)
+    resp = Response(
+        resp.status, {k.lower(): v for k, v in resp.getheaders()}, data)
+    if RECORDER:
+        RECORDER.store(record_path, method, dns_name + page, body, resp, sink)
+    return resp
+
+def read_body(resp, conn=None, deadline=None, sink=None):
+    '''
+    Reads and returns the whole body of http.client.HTTPResponse resp as
+    bytes, decompressing it as it arrives if it was sent with gzip or deflate
+    Content-Encoding. Any other encoding is returned as is.
+    If Connection conn and float deadline are given, each read is limited so
+    that the whole body must be read by deadline.
+    If BodySink sink is given, the body is written to it as it arrives
+    instead, and None is returned.
+    '''
+    encoding = (resp.getheader('Content-Encoding') or '').strip().lower()
+    compressed = encoding in ('gzip', 'x-gzip', 'deflate')
+    chunks = []
+    decompressor = None
+    while True:
+        if deadline:
+            conn.limit(deadline)
+        chunk = resp.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if not compressed:
+            if sink:
+                sink.write(chunk)
+            else:
+                chunks.append(chunk)
+            continue
+        if not decompressor:
+            # 32 allows either a gzip or zlib header to be detected
+            # "deflate" is supposed to have a zlib header, but some servers
+            # send raw deflate data, which has no header to check
+            wbits = zlib.MAX_WBITS | 32
+            if encoding == 'deflate' and (chunk[0] & 0x0f != 8
+                    or int.from_bytes(chunk[:2], 'big') % 31):
+                wbits = -zlib.MAX_WBITS
+            decompressor = zlib.decompressobj(wbits)
+        chunks.append(decompressor.decompress(chunk))
+        if sink:
+            sink.write(chunks.pop())
+    if decompressor:
+        chunks.append(decompressor.flush())
+        if sink:
+            sink.write(chunks.pop())
+    if sink:
+        return None
+    return b''.join(chunks)
+
+def send(dns_name, page, body=None, verbose=False, deadline=None, sink=None):
+    '''
+    Sends single request for string page (with optional body) to dns_name.
     If response code is not 200, prints message to stderr and returns None,
     unless it is 3xx, in which case the indicated location is requested by
-    calling this function recursively.
+    calling this function recursively (on another DNS name if the location
+    is absolute). 304 is the exception, returning the body from CACHE.
+    If float deadline is given, it applies to all requests made.
+    If BodySink sink is given, the body is streamed to it (from the cache,
+    if not modified) and an empty string is returned instead.
     If verbose is True, prints message to stdout.
     '''
-    if body:
-        conn.request('POST', page, body, HEADERS)
-    else:
-        conn.request('GET', page, headers=HEADERS)
-    resp = conn.getresponse()
-    # conn.host is possibly undocumented, but it isn't private either, so it
-    # should be ok, but it could be easily removed and is only used for verbose
+    method = 'POST' if body else 'GET'
+    headers = HEADERS
+    if CACHE:
+        cache_path = CACHE.path(method, dns_name, page, body)
+        headers = HEADERS | CACHE.validators(cache_path)
+    if sink:
+        sink.spool = cache_path + '.body' if CACHE else None
+    with tracing.span(
+            method + ' ' + dns_name + page, 'request') as trace_args:
+        resp = exchange(
+            dns_name, method, page, body, headers, deadline, sink=sink)
+        trace_args['status'] = resp.status
     if resp.status == 200:
         if verbose:
-            print(V_MSG % (conn.host, page, 'OK'))
-        return resp.read().decode('utf-8')
+            print(V_MSG % (dns_name, page, 'OK'))
+        if CACHE:
+            CACHE.store(cache_path, dns_name + page, resp, sink)
+        if resp.body is None:
+            return ''
+        return resp.body.decode('utf-8')
+    elif resp.status == 304 and CACHE and sink:
+        fp = CACHE.open_body(cache_path)
+        if fp:
+            # The cached body is already where it would be spooled
+            sink.spool = None
+            if verbose:
+                print(V_MSG % (dns_name, page, 'Not Modified, using cache'))
+            with fp:
+                for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                    sink.write(chunk)
+            return ''
+    elif resp.status == 304 and CACHE:
+        data = CACHE.load(cache_path)
+        if data is not None:
+            if verbose:
+                print(V_MSG % (dns_name, page, 'Not Modified, using cache'))
+            return data.decode('utf-8')
     elif resp.status // 100 == 3:
         # All types of redirects should do this
         if verbose:
-            print(V_MSG % (conn.host, page, resp.status) + ', redirecting...')
-        # This is just to flush it out to avoid http.client.ResponseNotReady
-        resp.read()
-        return send(conn, resp.getheader('Location'), body, verbose)
-    print(V_MSG % (conn.host, page, resp.status), file=stderr)
+            print(V_MSG % (dns_name, page, resp.status) + ', redirecting...')
+        location = urlsplit(resp.getheader('Location'))
+        if location.netloc:
+            dns_name = location.netloc
+        page = location.path or '/'
+        if location.query:
+            page += '?' + location.query
+        return send(dns_name, page, body, verbose, deadline, sink)
+    print(V_MSG % (dns_name, page, resp.status), file=stderr)
     return None
@@ -8,8 +8,12 @@ from abc import ABC, abstractmethod
 from json import dumps
 import os
 import re
+from sys import stderr
 from datetime import datetime
 
+from imagemeta import ImageIndex
+import tracing
+
 # These two constants are imported for Pierce Transit routes
 # Though they could be, they're not used for other agencies
 # This is because they're less accurate and well-maintained as a source
@@ -26,10 +30,36 @@ TIME_FORMAT = '%-m/%-d/%y %-H:%M'
 # More notes may be needed in the future
 EXISTENCE_NOTES = (
     ('Discontinued', 'discontinued'), ('',), ('Delisted', 'delisted'))
-TABLE_HTML = '    <h3>%s</h3>\n    <table>\n%s\n    </table>'
+# Names of existence values in exported data, and the fields of each row
+EXISTENCE_NAMES = ('discontinued', 'normal', 'delisted')
+EXPORT_FIELDS = ('agency', 'number', 'start', 'dest', 'number_link',
+    'start_link', 'dest_link', 'existence', 'completed', 'image')
+TABLE_HTML = '    <h3>%s</h3>\n    <table%s>\n%s\n    </table>'
+# In compact HTML, links are in data attributes instead of onclick handlers,
+# and the prefix shared by a table's links is given once, on the table
+PREFIX_HTML = ' data-p="%s"'
 ROW_HTML = '%s<tr>%s</tr>' % (' ' * 6, '%s' * 6)
-IMG_HTML = '<img src="%s" alt="%s" title="%s" width=100></img>'
+# Images are sized in advance (so the table doesn't reflow as they arrive),
+# and only fetched and decoded once they're about to be scrolled into view
+IMG_HTML = '<img src="%s" alt="%s" title="%s" width=%d%s loading="lazy"'\
+    + ' decoding="async"></img>'
+# When there are thumbnails, the <img> is wrapped with sources for each format
+PICTURE_HTML = '<picture>%s<img src="%s" srcset="%s" alt="%s" title="%s"'\
+    + ' width=%d%s loading="lazy" decoding="async"></img></picture>'
+HEIGHT_HTML = ' height=%d'
+# Images are displayed at this width, and should be square, with dimensions
+# which are multiples of it, to scale cleanly
+IMG_WIDTH = 100
+SIZE_WARNING = 'Warning: %s is %dx%d, but should be square, with dimensions'\
+    + ' multiples of %d'
+# Tuples of image path, width, and height already warned about, so that
+# rebuilds (as in watch or serve mode) only warn again if an image changes
+SIZE_WARNED = set()
+SOURCE_HTML = '<source type="%s" srcset="%s">'
 CSS_SPECIAL = 'x'
+# Maps asset paths to the paths they're published under, if assets are
+# published with digests in their names (see assets.py)
+ASSET_URLS = dict()
 # When using RouteListing object __module__ below, package name is visible
 # "routes.example" should be performantly truncated to "example"
 SUBMODULE_CUTOFF = len(__name__) + 1
@@ -59,7 +89,13 @@ class RouteListingInterface(ABC):
         if not hasattr(self, 'existence'):
             self.existence = 0
         self.datetime = 'Incomplete'
+        # Float time of completion, in seconds since the epoch
+        self.time = None
         self.img = None
+        # Tuple of image width and height in pixels, if known
+        self.size = None
+        # Set by thumbnails.ThumbnailStage if derived images are available
+        self.thumbs = None
 
     def __str__(self):
         '''Returns string representation of self, for debugging or -v.'''
@@ -117,20 +153,20 @@ class RouteListingInterface(ABC):
         self.start = self.start.replace('\\', '').replace('amp;', '').rstrip()
         self.dest = self.dest.replace('\\', '').replace('amp;', '').rstrip()
 
-    def to_html(self):
+    def to_html(self, prefix=None):
         '''
         Returns this row's <tr> HTML element for the final table.
         Handles special cases for visuals.
         Sanitizes self.start and self.dest "P&R" cases to output correct
         HTML ampersands in HTML.
+        If string prefix is given, the HTML is compact (see td), where prefix
+        begins every link opened in a new tab.
         '''
         if self.img:
             # This needs to output correct "/" HTML on Windows as well
-            i_link = self.img.replace(os.path.sep, '/')
-            i_td = td(
-                IMG_HTML % (i_link, self.number, self.number),
-                link=i_link,
-                blank=False)
+            i_link = asset_url(self.img)
+            i_td = td(self.img_html(i_link), link=i_link, blank=False,
+                prefix=prefix)
         else:
             i_td = td('')
         # Most CSS classes are agency-specific, there's only one that isn't
@@ -140,21 +176,73 @@ class RouteListingInterface(ABC):
         displaystart = self.start.replace('&', '&amp;')
         if len(self.dest):
             displaydest = self.dest.replace('&', '&amp;')
-            start_td = td(displaystart, 'n-' + final_class, link=self.links[1])
-            dest_td = td(displaydest, 'n-' + final_class, link=self.links[2])
+            start_td = td(displaystart, 'n-' + final_class,
+                link=self.links[1], prefix=prefix)
+            dest_td = td(displaydest, 'n-' + final_class,
+                link=self.links[2], prefix=prefix)
         else:
-            start_td = td(
-                displaystart, 'n-' + final_class, link=self.links[1], span=True)
+            start_td = td(displaystart, 'n-' + final_class,
+                link=self.links[1], span=True, prefix=prefix)
             # There is no destination, so this is what will be substituted in
             dest_td = ''
         return ROW_HTML % (
-            td(self.displaynum(), 'b-' + final_class, link=self.links[0]),
+            td(self.displaynum(), 'b-' + final_class, link=self.links[0],
+                prefix=prefix),
             start_td,
             dest_td,
             td(*EXISTENCE_NOTES[self.existence]),
             td(self.datetime, 'complete' if self.img else 'incomplete'),
             i_td)
 
+    def to_dict(self):
+        '''
+        Returns this RouteListing's data as a dictionary with keys
+        EXPORT_FIELDS, for machine-readable export. Time of completion is in
+        ISO 8601 format, and it and links and image path are None if absent.
+        The image path is the image's own, not any published URL (see
+        asset_url), so that it doesn't depend on how assets are published.
+        '''
+        completed = None
+        if self.time is not None:
+            completed = datetime.fromtimestamp(self.time).isoformat(
+                timespec='seconds')
+        return dict(zip(EXPORT_FIELDS, (
+            self.__module__[SUBMODULE_CUTOFF:],
+            self.number,
+            self.start,
+            self.dest,
+            *self.links,
+            EXISTENCE_NAMES[self.existence],
+            completed,
+            self.img.replace(os.path.sep, '/') if self.img else None)))
+
+    def img_html(self, i_link):
+        '''
+        Returns this RouteListing's <img> HTML element for its image at string
+        i_link. If it has thumbnails, these are displayed instead, using a
+        <picture> element so that browsers choose the best format they
+        support and the best density for their displays.
+        Its height is given too if its dimensions are known, so that space is
+        reserved for it before it's loaded.
+        '''
+        height = ''
+        if self.size:
+            width, img_height = self.size
+            height = HEIGHT_HTML % max(1, round(img_height * IMG_WIDTH / width))
+        if not self.thumbs:
+            return IMG_HTML % (
+                i_link, self.number, self.number, IMG_WIDTH, height)
+        # The last format is the one every browser supports
+        *sources, fallback = self.thumbs.items()
+        return PICTURE_HTML % (
+            ''.join(SOURCE_HTML % (mime, srcset(t)) for mime, t in sources),
+            fallback[1][0][0].replace(os.path.sep, '/'),
+            srcset(fallback[1]),
+            self.number,
+            self.number,
+            IMG_WIDTH,
+            height)
+
     def displaynum(self):
         '''
         Returns this RouteListing's HTML number, which could be the simple
@@ -172,6 +260,11 @@ class DataParserInterface(ABC):
     Nesting these three decorators seems valid in modern versions of Python 3
     in this case.
     '''
+    # Whether this agency's rendered HTML may be cached between runs (see
+    # fragments.py); DataParsers which request resources of their own in
+    # update() must set this False, since those aren't part of the cache key
+    CACHE_FRAGMENTS = True
+
     def __init__(self, agency, verbose, image_dir=None):
         '''
         Initializes attributes and RouteListings of self.
@@ -182,28 +275,53 @@ class DataParserInterface(ABC):
         # This is useful in to_html() and agency-specific requests
         self.verbose = verbose
         # We need this for generating HTML
+        # The index keeps what's known about images between runs, so only
+        # new or changed images need to be read
         if image_dir:
             self.image_dir = os.path.join(image_dir, agency)
-            self.images = os.listdir(self.image_dir)
+            self.image_index = ImageIndex(
+                self.image_dir, SHORT_FILENAME_PATTERN)
+            with tracing.span('images', 'build', agency=agency) as trace_args:
+                image_entries = self.image_index.scan()
+                self.image_index.save()
+                trace_args['count'] = len(image_entries)
         else:
             self.image_dir = None
-            self.images = []
+            self.image_index = None
+            image_entries = dict()
+        self.images = list(image_entries)
+        # Tuple of HTML and completed() counts, if these are already known
+        # from a previous run, in which case update() needn't be called
+        self.fragment = None
+        # Key under which this agency's HTML is cached, if it may be
+        self.fragment_key = None
+        # Whether every resource it was updated from was gotten; otherwise,
+        # its routes' existence may be wrong
+        self.complete = True
         # Dictionary will have numbers (agency-specific) as keys, and
         # RouteListings as values
         self.routelistings = dict()
-        for i in self.images:
-            match = SHORT_FILENAME_PATTERN.match(i)
+        for i, entry in image_entries.items():
             try:
                 # Get the RouteListing class (agency-specific), and instantiate
-                rl = self.ROUTELISTING(match.group(1))
-                if i.startswith('*'):
+                rl = self.ROUTELISTING(entry.key)
+                if entry.delisted:
                     rl.existence = 2
                 rl.img = os.path.join(self.image_dir, i)
-                secs = os.stat(rl.img).st_birthtime
-                rl.datetime = datetime.fromtimestamp(secs).strftime(TIME_FORMAT)
+                if entry.width and entry.height:
+                    rl.size = (entry.width, entry.height)
+                    if ((entry.width != entry.height
+                            or entry.width % IMG_WIDTH) and
+                            (rl.img,) + rl.size not in SIZE_WARNED):
+                        SIZE_WARNED.add((rl.img,) + rl.size)
+                        print(SIZE_WARNING % (
+                            rl.img, entry.width, entry.height, IMG_WIDTH),
+                            file=stderr)
+                rl.time = entry.time
+                rl.datetime = datetime.fromtimestamp(entry.time).strftime(
+                    TIME_FORMAT)
                 self.routelistings[rl.number] = rl
-            # This can fail because match is None, or AttributeError is raised
-            # by rl.__init__
+            # AttributeError can be raised by rl.__init__
             except AttributeError:
                 continue
 
@@ -234,9 +352,10 @@ class DataParserInterface(ABC):
     def INITIAL_REQUESTS(self):
         '''
         This method returns a set whose contents are either strings (URIs
-        preceded by DNS names, i.e. website URLs) for GET requests, or tuples
-        containing a string URL and a request body for POST requests.
-        These are provided to http.client.HTTPSConnection.request,
+        preceded by DNS names, i.e. website URLs) for GET requests, tuples
+        containing a string URL and a request body for POST requests, or
+        requests.CustomRequests for anything more complicated.
+        The first two are provided to http.client.HTTPSConnection.request,
         though an invariant headers field is added.
         After this first step is handled by main program (because some
         agencies might share resources), DataParsers are free to request
@@ -286,6 +405,8 @@ class DataParserInterface(ABC):
         Returns two integers: the number of total existing routes in
         self.routelistings, and the number of those which are completed.
         '''
+        if self.fragment:
+            return self.fragment[1]
         total = 0
         completed = 0
         for rl in self.routelistings.values():
@@ -295,13 +416,18 @@ class DataParserInterface(ABC):
                     completed += 1
         return total, completed
 
-    def to_html(self):
+    def to_html(self, compact=False):
         '''
         Returns HTML generated by this DataParser, which will be composed of
         a header and a table made of HTML rows generated by RouteListings in
         self.routelistings.
+        If compact is True, links are given in data attributes for a script
+        to open (see td), after the longest prefix they all share, which is
+        given once on the table.
         If self.verbose is True, prints messages to stdout.
         '''
+        if self.fragment:
+            return self.fragment[0]
         if self.verbose:
             print('Sorting %s listings...' % self.agency, end='', flush=True)
         listings = sorted(self.routelistings.values())
@@ -309,8 +435,39 @@ class DataParserInterface(ABC):
             print('Done')
             for l in listings:
                 print(l)
-        rows = '\n'.join(l.to_html() for l in listings)
-        return TABLE_HTML % (self.AGENCY_FULL_NAME, rows)
+        if not compact:
+            rows = '\n'.join(l.to_html() for l in listings)
+            return TABLE_HTML % (self.AGENCY_FULL_NAME, '', rows)
+        # Links to images open in the same tab, and aren't included
+        prefix = os.path.commonprefix(
+            [link for l in listings for link in l.links if link])
+        rows = '\n'.join(l.to_html(prefix) for l in listings)
+        return TABLE_HTML % (self.AGENCY_FULL_NAME, PREFIX_HTML % prefix, rows)
+
+    def export_rows(self):
+        '''
+        Generates a dictionary for each RouteListing in self.routelistings,
+        in order, as returned by its to_dict method.
+        '''
+        for rl in sorted(self.routelistings.values()):
+            yield rl.to_dict()
+
+def asset_url(path):
+    '''
+    Returns the URL, relative to the website root, for the asset at string
+    path, which is its published path if it's in ASSET_URLS.
+    '''
+    path = path.replace(os.path.sep, '/')
+    return ASSET_URLS.get(path, path)
+
+def srcset(thumbs):
+    '''
+    Returns the value of an HTML srcset attribute for a list of tuples of
+    string image path and integer pixel density.
+    '''
+    return ', '.join(
+        '%s %dx' % (path.replace(os.path.sep, '/'), density)
+        for path, density in thumbs)
 
 def td(data, css_class=None, **kwargs):
     '''
@@ -320,14 +477,25 @@ def td(data, css_class=None, **kwargs):
     If td should link to something, string link should be set to the location
     (and if link should open in same tab, bool blank should be False).
     If td should span an extra column, bool span should be True.
+    If string prefix is given, td is compact: instead of an onclick handler,
+    it has a data-l attribute with the rest of a link after prefix (which
+    its table gives), or a data-s attribute with a link for the same tab, for
+    a single script to open when clicked.
     '''
     td_elem = ['td']
     if css_class:
         td_elem.append('class="%s"' % css_class)
-    if kwargs.get('link', None):
+    link = kwargs.get('link', None)
+    prefix = kwargs.get('prefix', None)
+    if link and prefix is not None:
+        if kwargs.get('blank', True):
+            td_elem.append('data-l="%s"' % link[len(prefix):])
+        else:
+            td_elem.append('data-s="%s"' % link)
+    elif link:
         behavior = '_blank' if kwargs.get('blank', True) else '_self'
         td_elem.append(
-            'onclick="window.open(\'%s\', \'%s\')"' % (kwargs['link'], behavior))
+            'onclick="window.open(\'%s\', \'%s\')"' % (link, behavior))
     if kwargs.get('span', False):
         td_elem.append('colspan="2"')
     return '<%s>%s</td>' % (' '.join(td_elem), data)
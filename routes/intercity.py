@@ -49,6 +49,8 @@ class DataParser(DataParserInterface):
     AGENCY_FULL_NAME = 'Intercity Transit'
     ROUTELISTING = RouteListing
     INITIAL_REQUESTS = {MAIN_URL}
+    # Timetables are requested in update()
+    CACHE_FRAGMENTS = False
 
     def update(self, resources):
         html = resources[MAIN_URL]
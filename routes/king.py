@@ -6,12 +6,15 @@ See __init__.py for documentation.
 import re
 
 from . import DataParserInterface, RouteListingInterface, CSS_SPECIAL
+from requests import PatternRequest
 
 MAIN_URL = 'cdn.kingcounty.gov/-/media/king-county/depts/metro/'\
     + 'fe-apps/schedule/08302025/js/find-a-schedule-js.js'
 TROLLEY_URL = 'metro.kingcounty.gov/up/rr/m-trolley.html'
 ROUTE_PATTERN = re.compile(r'<option value="([^"]+)">(DART +)?([A-Z\d]+?)'\
     + r'(?: Line| Shuttle)? - (.*?)<\/option>')
+# The schedule bundle is several megabytes, so it's matched as it downloads
+MAIN_REQ = PatternRequest(MAIN_URL, ROUTE_PATTERN)
 SERVICE_PATTERN = re.compile(r'Service between (.*) and (?:the | )(.*)')
 LINK_BASE = 'https://kingcounty.gov'
 # King is the only reliable agency for route directions corresponding to
@@ -70,24 +73,22 @@ class RouteListing(RouteListingInterface):
 class DataParser(DataParserInterface):
     AGENCY_FULL_NAME = 'King County Metro'
     ROUTELISTING = RouteListing
-    INITIAL_REQUESTS = {MAIN_URL, TROLLEY_URL}
+    INITIAL_REQUESTS = {MAIN_REQ, TROLLEY_URL}
 
     def update(self, resources):
-        main_js = resources[MAIN_URL]
-        if not main_js:
+        matches = resources[MAIN_REQ]
+        if not matches:
             return
         trolley_html = resources[TROLLEY_URL]
         if not trolley_html:
             # Not a disaster, we can just render without visible trolley colors
             trolley_html = ''
-        for match in ROUTE_PATTERN.finditer(main_js):
-            if match.group(2):
-                number = match.group(2).rstrip() + match.group(3)
-            else:
-                number = match.group(3)
+        for link, dart, number, termini in matches:
+            if dart:
+                number = dart.rstrip() + number
             rl = self.get_add_routelisting(number)
             rl.existence = 1
-            rl.parse_termini(match.group(4))
-            rl.set_links(LINK_BASE + match.group(1), LINK_OPTIONS)
+            rl.parse_termini(termini)
+            rl.set_links(LINK_BASE + link, LINK_OPTIONS)
             if 'Route ' + rl.number in trolley_html:
                 rl.css_class = 'trolley'
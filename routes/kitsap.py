@@ -3,10 +3,10 @@ Constants and implementations of package interfaces for Kitsap Transit.
 See __init__.py for documentation.
 '''
 
-import http.client
 from hashlib import sha256
 import hmac
-from json import loads
+from json import dumps, loads
+import os
 import pickle
 import re
 from datetime import datetime, timezone
@@ -14,6 +14,10 @@ from time import time
 from sys import stderr
 
 from . import DataParserInterface, RouteListingInterface, CSS_SPECIAL
+import atomic
+import requests
+import tracing
+from requests import CustomRequest, exchange, deadline, NETWORK_ERRORS
 
 # This isn't even everything we need
 # This first resource is very out of date, but we won't rely on it much
@@ -41,15 +45,25 @@ class RouteListing(RouteListingInterface):
             self.css_class = CSS_SPECIAL
         super().__init__()
 
+class TrackerRequest(CustomRequest):
+    '''
+    The kttracker listings can't be requested by URL alone, so this performs
+    kitsap_request alongside all other initial requests.
+    '''
+    def perform(self, verbose=False):
+        return kitsap_request(verbose)
+
+TRACKER_REQ = TrackerRequest()
+
 class DataParser(DataParserInterface):
     AGENCY_FULL_NAME = 'Kitsap Transit'
     ROUTELISTING = RouteListing
-    INITIAL_REQUESTS = {MAIN_URL, WORKER_DRIVER_URL}
+    INITIAL_REQUESTS = {MAIN_URL, WORKER_DRIVER_URL, TRACKER_REQ}
 
     def update(self, resources):
         json = resources[MAIN_URL]
         wd_html = resources[WORKER_DRIVER_URL]
-        tracker_json = kitsap_request(self.verbose)
+        tracker_json = resources[TRACKER_REQ]
         if not json or not wd_html or not tracker_json:
             return
         tracker_list = loads(tracker_json)['bustime-response']['routes']
@@ -123,50 +137,135 @@ T_E = b'\x80\x04\x95\xd5\x00\x00\x00\x00\x00\x00\x00}\x94(KOKAKNKBKfKCKxKDKkK'\
     + b'iKnKuKoKcKpKnKqKCKrKIKsKRKtKyKuKoKvKSKwKaKxKjKyKGKzu.'
 HEADERS = {
     'Accept': 'application/json',
+    'Accept-Encoding': 'gzip, deflate',
     'Cache-Control': 'no-cache',
     'Connection': 'keep-alive',
     'Pragma': 'no-cache',
     'User-Agent': 'ManyBusesAway',
     'sec-ch-ua': 'ManyBusesAway'}
+TRACKER_DNS_NAME = 'kttracker.com'
 U_0 = '/bustime'
 U_1 = '/api/v3/gettime?requestType=gettime&unixTime=true&key=%s&format=json&xtime=%d'
 U_2 = '/api/v3/getroutes?requestType=getroutes&locale=en&key=%s&format=json&xtime=%d'
 V_MSG = 'HTTPS requests for kttracker.com got response %s'
 
+# Server clock offset, in milliseconds, is kept for this many seconds
+CLOCK_FILENAME = 'kttracker.json'
+CLOCK_LIFETIME = 86400
+# Offset and local time it was measured, to skip gettime when possible
+clock = None
+
 def kitsap_request(verbose=False):
     '''
     Returns required kttracker listings.
-    Makes and closes one http.client.HTTPSConnection.
-    If a response code is not 200, prints message to stderr and returns None.
+    Uses pooled connections, the configured timeouts, and any recording or
+    replaying of requests, through requests.exchange.
+    The listings request must be signed with the server's time, so that is
+    requested first unless its offset from local time is already known from
+    a recent run; if a request signed with a known offset fails, the offset
+    is requested again.
+    If a response code is not 200, or a network error occurs, prints message
+    to stderr and returns None.
     If verbose is True, prints message to stdout.
     '''
+    limit = deadline()
+    try:
+        offset = load_clock()
+        if offset is not None:
+            resp = get_routes(offset, limit)
+            if resp.status == 200:
+                if verbose:
+                    print(V_MSG % 'OK, using known clock offset')
+                return resp.body.decode('utf-8')
+        offset = get_clock(limit)
+        if offset is None:
+            return None
+        resp = get_routes(offset, limit)
+    except NETWORK_ERRORS as e:
+        print(V_MSG % (str(e) or type(e).__name__), file=stderr)
+        return None
+    if resp.status == 200:
+        save_clock(offset)
+        if verbose:
+            print(V_MSG % 'OK')
+        return resp.body.decode('utf-8')
+    print(V_MSG % resp.status, file=stderr)
+    return None
+
+def get_clock(limit):
+    '''
+    Returns the offset of the kttracker server's clock from local time, in
+    milliseconds, or None on failure (printing message to stderr).
+    Float limit is the deadline for the request.
+    '''
     u = pickle.loads(T_E)
-    connection = http.client.HTTPSConnection('kttracker.com')
-    connection.request('GET',
-        U_0 + U_1 % (K_E.translate(u), round(time() * 1000)),
-        headers=HEADERS)
-    resp = connection.getresponse()
+    now = round(time() * 1000)
+    # The timestamps and signatures in these requests vary, so requests are
+    # recorded or replayed by their paths only
+    with tracing.span('kttracker clock', 'request') as trace_args:
+        resp = exchange(TRACKER_DNS_NAME, 'GET',
+            U_0 + U_1 % (K_E.translate(u), now),
+            headers=HEADERS, deadline=limit, key=U_0 + U_1.partition('?')[0])
+        trace_args['status'] = resp.status
     if resp.status != 200:
         print(V_MSG % resp.status, file=stderr)
-        connection.close()
         return None
-    jsonr = resp.read().decode('utf-8')
-    ht = int(loads(jsonr)["bustime-response"]["tm"]) + 20
+    return int(loads(resp.body.decode('utf-8'))["bustime-response"]["tm"]) - now
+
+def get_routes(offset, limit):
+    '''
+    Returns the requests.Response to a listings request signed using the
+    kttracker server's time, given its integer offset in milliseconds.
+    Float limit is the deadline for the request.
+    '''
+    u = pickle.loads(T_E)
+    ht = round(time() * 1000) + offset + 20
     dt = datetime.fromtimestamp(ht // 1000).astimezone(timezone.utc).strftime(
         '%a, %d %b %Y %H:%M:%S GMT')
     key = U_2 % (K_E.translate(u), ht) + dt
     h = hmac.new(bytes(H_E.translate(u), 'utf-8'), key.encode('utf-8'), sha256)
     newheaders = {'X-Date': dt, 'X-Request-ID': h.hexdigest()}
-    connection.request('GET',
-        U_0 + U_2 % (K_E.translate(u), ht),
-        headers=HEADERS | newheaders)
-    resp = connection.getresponse()
-    if resp.status == 200:
-        if verbose:
-            print(V_MSG % 'OK')
-        returnval = resp.read().decode('utf-8')
-    else:
-        print(V_MSG % resp.status, file=stderr)
-        returnval = None
-    connection.close()
-    return returnval
+    with tracing.span('kttracker listings', 'request') as trace_args:
+        resp = exchange(TRACKER_DNS_NAME, 'GET',
+            U_0 + U_2 % (K_E.translate(u), ht),
+            headers=HEADERS | newheaders, deadline=limit,
+            key=U_0 + U_2.partition('?')[0])
+        trace_args['status'] = resp.status
+    return resp
+
+def load_clock():
+    '''
+    Returns the known kttracker clock offset if it was measured recently,
+    whether by this process or (if requests has a CACHE_DIR) a previous run,
+    or None otherwise.
+    '''
+    global clock
+    if not clock and requests.CACHE_DIR:
+        try:
+            with open(os.path.join(requests.CACHE_DIR, CLOCK_FILENAME)) as fp:
+                saved = loads(fp.read())
+            # Anything else in the file is ignored, as if it weren't there
+            if (isinstance(saved, list) and len(saved) == 2
+                    and all(isinstance(n, (int, float)) for n in saved)):
+                clock = tuple(saved)
+        except (OSError, ValueError, TypeError):
+            pass
+    if clock and time() - clock[1] < CLOCK_LIFETIME:
+        return clock[0]
+    return None
+
+def save_clock(offset):
+    '''
+    Keeps integer offset as the kttracker clock offset, in this process and
+    (if requests has a CACHE_DIR) for later runs.
+    '''
+    global clock
+    clock = (offset, time())
+    if requests.CACHE_DIR:
+        path = os.path.join(requests.CACHE_DIR, CLOCK_FILENAME)
+        try:
+            # This runs in a prefetch thread, so the file is never left
+            # half written for another run to read
+            atomic.write_if_changed(path, dumps(clock).encode())
+        except OSError:
+            pass
@@ -33,6 +33,8 @@ class DataParser(DataParserInterface):
     AGENCY_FULL_NAME = 'Skagit Transit'
     ROUTELISTING = RouteListing
     INITIAL_REQUESTS = {MAIN_URL}
+    # Timetables are requested in update()
+    CACHE_FRAGMENTS = False
 
     def update(self, resources):
         # This function is very convoluted, but basically, if a route's termini
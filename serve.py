@@ -0,0 +1,175 @@
+'''
+Serves the page from memory over HTTP, along with the files it refers to,
+while agencies are refreshed in the background on their own intervals.
+Until an agency's refresh finishes (or if it fails), the page keeps its
+previous table, so a request never waits on an agency's website.
+'''
+
+import gzip
+from hashlib import sha256
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import os
+import posixpath
+from sys import stderr
+import threading
+from urllib.parse import unquote, urlsplit
+
+from output import GZIP_LEVEL
+
+# Only this machine can connect; a real web server should sit in front
+HOST = '127.0.0.1'
+REFRESH_ERROR_MSG = 'Could not refresh %s, keeping its previous table: %s'
+
+class Site:
+    '''
+    Holds the current page, as bytes both plain and gzipped, along with its
+    ETag, under a lock, so that requests always get a complete page.
+    String path is the URL path it's served at (as well as at "/").
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.page = (b'', b'', '""')
+
+    def set_page(self, html):
+        '''Replaces the page with string html.'''
+        body = html.encode('utf-8')
+        # mtime=0 keeps the compressed bytes the same for the same page
+        gzipped = gzip.compress(body, GZIP_LEVEL, mtime=0)
+        etag = '"%s"' % sha256(body).hexdigest()[:32]
+        with self.lock:
+            self.page = (body, gzipped, etag)
+
+    def get_page(self):
+        '''Returns a tuple of the page, gzipped page, and ETag.'''
+        with self.lock:
+            return self.page
+
+class PageServer(ThreadingHTTPServer):
+    '''
+    ThreadingHTTPServer serving Site site's page, and files in string
+    directory, but only those at (or within directories at) the relative
+    paths in iterable paths; anything else, such as a response cache or
+    .git, is never served.
+    '''
+    # Refreshes and open connections shouldn't keep the program running
+    daemon_threads = True
+
+    def __init__(self, port, site, directory, paths, verbose=False):
+        super().__init__((HOST, port), PageHandler)
+        self.site = site
+        self.directory = directory
+        # As URL paths, without a leading "/"
+        self.paths = set(
+            os.path.normpath(p).replace(os.path.sep, '/') for p in paths)
+        self.verbose = verbose
+
+class PageHandler(SimpleHTTPRequestHandler):
+    '''
+    Answers requests for the page from memory, with gzip if accepted and
+    304 responses for unchanged pages, and any other request from files if
+    they may be served, or with 404 otherwise.
+    '''
+    def __init__(self, request, client_address, server):
+        super().__init__(
+            request, client_address, server, directory=server.directory)
+
+    def do_GET(self):
+        if self.send_page(True):
+            return
+        if self.allowed():
+            super().do_GET()
+        else:
+            self.send_error(404)
+
+    def do_HEAD(self):
+        if self.send_page(False):
+            return
+        if self.allowed():
+            super().do_HEAD()
+        else:
+            self.send_error(404)
+
+    def allowed(self):
+        '''
+        Returns whether the requested path is one of the server's paths, or
+        within one of them.
+        '''
+        path = posixpath.normpath(unquote(urlsplit(self.path).path))
+        # Anything outside the directory normalizes to a path starting there
+        path = path.lstrip('/')
+        return any(path == p or path.startswith(p + '/')
+            for p in self.server.paths if p != '.')
+
+    def send_page(self, with_body):
+        '''
+        Responds with the page if it was requested, including it if bool
+        with_body is True. Returns whether the page was requested.
+        '''
+        path = urlsplit(self.path).path
+        site = self.server.site
+        if path not in ('/', site.path):
+            return False
+        body, gzipped, etag = site.get_page()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzipped
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+        return True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class Refresher(threading.Thread):
+    '''
+    Thread calling function refresh every number interval seconds until
+    threading.Event stop is set. Exceptions from refresh are printed to
+    stderr with string name, and it's tried again after the next interval.
+    '''
+    def __init__(self, name, interval, refresh, stop):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.refresh = refresh
+        self.stop = stop
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(REFRESH_ERROR_MSG % (self.name, str(e) or
+                    type(e).__name__), file=stderr)
+
+def serve(port, site, refreshers, paths, directory=os.curdir,
+        verbose=False):
+    '''
+    Serves Site site on integer port, and files from string directory at
+    iterable paths (as for PageServer), until interrupted, with Refreshers
+    refreshers (sharing their stop Event) running meanwhile.
+    '''
+    server = PageServer(port, site, directory, paths, verbose)
+    for r in refreshers:
+        r.start()
+    print('Serving on http://%s:%d%s' % (HOST, port, site.path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for r in refreshers:
+            r.stop.set()
+        server.server_close()
@@ -0,0 +1,158 @@
+'''
+Keeps a snapshot of every route listing from each build in a SQLite
+database, so that changes to agencies' routes (added, dropped, or renamed,
+or newly completed) can be listed across any number of builds.
+Listings are stored once for each distinct set of values, and each build
+refers to the listings it had, so a build which changed nothing costs only
+a row per listing in an index.
+This can be run to list builds, or the changes since one of them:
+    python3 snapshots.py <database> [--since <build>]
+'''
+
+import argparse
+from datetime import datetime
+from hashlib import sha256
+from json import dumps
+import sqlite3
+from time import time
+
+from routes import EXPORT_FIELDS, TIME_FORMAT
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    agencies TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS listings (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL UNIQUE,
+    %s);
+CREATE TABLE IF NOT EXISTS build_listings (
+    build INTEGER NOT NULL REFERENCES builds(id),
+    listing INTEGER NOT NULL REFERENCES listings(id),
+    PRIMARY KEY (build, listing)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS build_listings_listing
+    ON build_listings(listing);
+''' % ',\n    '.join(EXPORT_FIELDS)
+# Listings are identified across builds by these fields
+KEY_FIELDS = ('agency', 'number')
+# How each change is printed, for added, removed, and changed listings
+ADDED_FORMAT = '  + %s %s: %s'
+REMOVED_FORMAT = '  - %s %s'
+CHANGED_FORMAT = '  ~ %s %s: %s %r -> %r'
+BUILD_FORMAT = '%d  %s  %s'
+
+def connect(path):
+    '''
+    Returns a sqlite3.Connection to the database at string path, creating
+    its tables if needed.
+    '''
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    return db
+
+def record(path, agencies, rows):
+    '''
+    Records a build of iterable agencies (strings), whose route listings
+    are iterable rows (dictionaries with keys EXPORT_FIELDS, as from
+    DataParserInterface.export_rows), into the database at string path.
+    Returns the integer id of the build.
+    '''
+    db = connect(path)
+    # Everything is committed at once, or not at all
+    with db:
+        build = db.execute('INSERT INTO builds (time, agencies) VALUES (?, ?)',
+            (time(), ' '.join(agencies))).lastrowid
+        insert = 'INSERT OR IGNORE INTO listings (digest, %s) VALUES (?%s)' % (
+            ', '.join(EXPORT_FIELDS), ', ?' * len(EXPORT_FIELDS))
+        for row in rows:
+            values = tuple(row[f] for f in EXPORT_FIELDS)
+            digest = sha256(dumps(values).encode()).hexdigest()
+            db.execute(insert, (digest,) + values)
+            db.execute('INSERT OR IGNORE INTO build_listings SELECT ?, id'
+                ' FROM listings WHERE digest = ?', (build, digest))
+    db.close()
+    return build
+
+def listings(db, build):
+    '''
+    Returns a dictionary of KEY_FIELDS tuples to dictionaries of listings'
+    fields, for the listings of integer build in sqlite3.Connection db.
+    '''
+    cursor = db.execute('SELECT %s FROM build_listings JOIN listings'
+        ' ON listings.id = listing WHERE build = ?' % ', '.join(EXPORT_FIELDS),
+        (build,))
+    result = dict()
+    for values in cursor:
+        row = dict(zip(EXPORT_FIELDS, values))
+        result[tuple(row[f] for f in KEY_FIELDS)] = row
+    return result
+
+def diff(old, new, agencies):
+    '''
+    Generates the changes from dictionary old to dictionary new (each as
+    returned by listings), only for listings of agencies in set agencies, as
+    strings for printing.
+    '''
+    for key in sorted(set(old) | set(new)):
+        if key[0] not in agencies:
+            continue
+        if key not in old:
+            row = new[key]
+            yield ADDED_FORMAT % (key + (' - '.join(
+                filter(None, (row['start'], row['dest']))),))
+        elif key not in new:
+            yield REMOVED_FORMAT % key
+        else:
+            for f in EXPORT_FIELDS:
+                if old[key][f] != new[key][f]:
+                    yield CHANGED_FORMAT % (key + (f, old[key][f], new[key][f]))
+
+def changes(path, since=None):
+    '''
+    Generates strings describing every build in the database at string path
+    from integer build since on (or every build, if since is None), each
+    after the first followed by what changed in it from the build before.
+    Builds whose listings are exactly those of the build before are found
+    without comparing any fields.
+    '''
+    db = connect(path)
+    builds = db.execute('SELECT id, time, agencies FROM builds'
+        ' WHERE id >= ? ORDER BY id', (since or 0,)).fetchall()
+    previous = None
+    previous_ids = None
+    for build, t, agencies in builds:
+        ids = set(r[0] for r in db.execute(
+            'SELECT listing FROM build_listings WHERE build = ?', (build,)))
+        yield BUILD_FORMAT % (build,
+            datetime.fromtimestamp(t).strftime(TIME_FORMAT), agencies)
+        if previous and ids != previous_ids:
+            # Only agencies in both builds can be compared
+            common = set(agencies.split()) & set(previous[1].split())
+            yield from diff(
+                listings(db, previous[0]), listings(db, build), common)
+        previous = (build, agencies)
+        previous_ids = ids
+    db.close()
+
+def main():
+    '''
+    Entry point when run directly: prints every build in a database and
+    what changed in each, optionally only since a given build.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'database',
+        type=str,
+        help='database written by manybusesaway.py --snapshot-db')
+    parser.add_argument(
+        '--since',
+        type=int,
+        metavar='BUILD',
+        help='only list changes after this build')
+    args = parser.parse_args()
+    for line in changes(args.database, args.since):
+        print(line)
+
+if __name__ == '__main__':
+    main()
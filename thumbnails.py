@@ -0,0 +1,159 @@
+'''
+Derives small versions of route images, in modern formats, for display in
+the table; the original images are still linked to from it.
+This is the only part of this program which uses a third-party library
+(Pillow), so it's optional; without Pillow, original images are displayed.
+Images are derived in parallel by separate processes, and derived images are
+named by the digests of their originals, so unchanged images are skipped;
+so are images which couldn't be derived before, which are remembered by
+marker files named the same way.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import io
+import multiprocessing
+import os
+from sys import stderr
+
+from atomic import write_if_changed
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Width of images in the table; each is derived at each of these densities
+DISPLAY_WIDTH = 100
+DENSITIES = (1, 2)
+# Pillow format names, file extensions, and MIME types, in order of
+# preference for browsers; the last is the fallback for the <img> itself
+FORMATS = (
+    ('AVIF', 'avif', 'image/avif'),
+    ('WEBP', 'webp', 'image/webp'),
+    ('JPEG', 'jpg', 'image/jpeg'))
+QUALITY = 80
+# Extension of marker files for images which can't be derived
+SKIP_EXT = 'skip'
+MISSING_MSG = 'Pillow is not installed, so thumbnails will not be derived'
+
+class ThumbnailStage:
+    '''
+    Derives thumbnails of DataParsers' images into a directory, in
+    parallel with the rest of the build. DataParsers are given to submit() as
+    soon as they're constructed, and once finish() returns, their
+    RouteListings' thumbs attributes refer to the derived images.
+    A stage can be used for any number of builds in turn (each ending with
+    finish()), sharing its worker processes, until close() is called.
+    '''
+    def __init__(self, directory, verbose=False):
+        self.directory = directory
+        self.verbose = verbose
+        # Tuples of RouteListing, dictionary of thumbs, list of Futures, and
+        # path of the marker to write if they fail
+        self.pending = []
+        self.executor = None
+        self.formats = ()
+        if not Image:
+            print(MISSING_MSG, file=stderr)
+            return
+        Image.init()
+        # AVIF support depends on how Pillow was built
+        self.formats = tuple(f for f in FORMATS if f[0] in Image.SAVE)
+        # Workers are started from threads which may hold locks (such as
+        # stderr's) at the time, so they mustn't be forked
+        self.executor = ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, data_parser):
+        '''
+        Starts deriving any missing thumbnails for the images of DataParser
+        data_parser, and removes any of its thumbnails no longer needed.
+        '''
+        if not self.executor or not data_parser.image_index:
+            return
+        agency_dir = os.path.join(self.directory, data_parser.agency)
+        os.makedirs(agency_dir, exist_ok=True)
+        existing = set(os.listdir(agency_dir))
+        needed = set()
+        for rl in data_parser.routelistings.values():
+            if not rl.img:
+                continue
+            entry = data_parser.image_index.entries[os.path.basename(rl.img)]
+            marker = '%s.%s.%s' % (entry.key, entry.digest, SKIP_EXT)
+            if marker in existing:
+                # This image couldn't be derived before, and hasn't changed
+                needed.add(marker)
+                continue
+            thumbs = dict()
+            missing = []
+            for pil_format, ext, mime in self.formats:
+                thumbs[mime] = []
+                for density in DENSITIES:
+                    name = '%s.%s.%d.%s' % (
+                        entry.key, entry.digest, DISPLAY_WIDTH * density, ext)
+                    path = os.path.join(agency_dir, name)
+                    thumbs[mime].append((path, density))
+                    needed.add(name)
+                    if name not in existing:
+                        missing.append(
+                            (path, pil_format, DISPLAY_WIDTH * density))
+            futures = []
+            if missing:
+                futures.append(self.executor.submit(derive, rl.img, missing))
+            self.pending.append(
+                (rl, thumbs, futures, os.path.join(agency_dir, marker)))
+        for name in existing - needed:
+            os.remove(os.path.join(agency_dir, name))
+
+    def finish(self):
+        '''
+        Waits for all thumbnails to be derived, then sets each RouteListing's
+        thumbs attribute to a dictionary of MIME types to lists of (path,
+        density) tuples, in order of preference. Images which couldn't be
+        derived (such as animated images, which would lose their animation)
+        are left to be displayed as they are, and marked so that they aren't
+        tried again until they change.
+        '''
+        if not self.executor:
+            return
+        for rl, thumbs, futures, marker in self.pending:
+            if all(f.result() for f in futures):
+                rl.thumbs = thumbs
+                continue
+            open(marker, 'w').close()
+            if self.verbose:
+                print('Displaying %s without thumbnails' % rl.img)
+        self.pending = []
+
+    def close(self):
+        '''Stops the worker processes, once the stage is no longer needed.'''
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+def derive(source, outputs):
+    '''
+    Derives images from the image at string path source, for each tuple in
+    list outputs of string path, Pillow format name, and integer width.
+    Returns whether this was possible; animated images and any which can't be
+    decoded are not derived.
+    This runs in a separate process.
+    '''
+    try:
+        with Image.open(source) as im:
+            if getattr(im, 'is_animated', False):
+                return False
+            im = im.convert('RGB')
+            for path, pil_format, width in outputs:
+                height = max(1, round(im.height * width / im.width))
+                resized = im.resize((width, height), Image.LANCZOS)
+                # Written atomically so that an interrupted build can't leave
+                # a truncated image looking complete
+                buffer = io.BytesIO()
+                resized.save(buffer, pil_format, quality=QUALITY)
+                write_if_changed(path, buffer.getvalue())
+    except (OSError, ValueError) as e:
+        print('Could not derive thumbnails of %s: %s' % (source, e),
+            file=stderr)
+        return False
+    return True
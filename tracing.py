@@ -0,0 +1,110 @@
+'''
+Records how long each part of a build takes, as spans of time on each
+thread, and writes them as JSON in the Trace Event Format, which can be
+opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing to see
+where the time goes and which agency or request a build was waiting on.
+Nothing is recorded unless enable() has been called, so spans cost almost
+nothing otherwise.
+'''
+
+from contextlib import contextmanager
+from json import dumps
+import os
+import threading
+from time import perf_counter
+
+import atomic
+
+PROCESS_NAME = 'ManyBusesAway'
+# List of events recorded so far, or None if not tracing
+EVENTS = None
+# Dictionary of native thread IDs to thread names, for naming tracks
+THREADS = dict()
+LOCK = threading.Lock()
+# Time from which events' timestamps are measured
+ORIGIN = perf_counter()
+
+def enable():
+    '''
+    Starts recording spans, measuring their times from now.
+    '''
+    global EVENTS, ORIGIN
+    EVENTS = []
+    ORIGIN = perf_counter()
+
+def enabled():
+    '''
+    Returns whether spans are being recorded.
+    '''
+    return EVENTS is not None
+
+def now():
+    '''
+    Returns the current time as a float, for giving to add().
+    '''
+    return perf_counter()
+
+def add(name, category, start, end=None, **args):
+    '''
+    Records a span of string name in string category on the current thread,
+    from float start to float end (as returned by now(); end defaults to
+    now), with keyword arguments args shown alongside it.
+    '''
+    if EVENTS is None:
+        return
+    if end is None:
+        end = perf_counter()
+    thread = threading.current_thread()
+    tid = thread.native_id
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        # Timestamps and durations are in microseconds
+        'ts': round((start - ORIGIN) * 1e6, 1),
+        'dur': round((end - start) * 1e6, 1),
+        'pid': os.getpid(),
+        'tid': tid,
+        'args': args}
+    with LOCK:
+        EVENTS.append(event)
+        THREADS.setdefault(tid, thread.name)
+
+@contextmanager
+def span(name, category, **args):
+    '''
+    Context manager recording the time spent within it as a span, as add()
+    does. It gives dictionary args, to which more arguments can be added
+    before it exits. If it exits with an exception, the exception's type is
+    added as argument "error".
+    '''
+    if EVENTS is None:
+        yield args
+        return
+    start = perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = type(e).__name__
+        raise
+    finally:
+        add(name, category, start, **args)
+
+def write(path):
+    '''
+    Writes every span recorded so far to string path as a JSON trace, with
+    each thread's track named after it. Does nothing if not tracing.
+    '''
+    if EVENTS is None:
+        return
+    pid = os.getpid()
+    with LOCK:
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': PROCESS_NAME}}]
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+            'tid': tid, 'args': {'name': name}}
+            for tid, name in THREADS.items())
+        # Events are sorted so that viewers nest spans correctly
+        events.extend(sorted(EVENTS, key=lambda e: (e['ts'], -e['dur'])))
+    atomic.write_if_changed(path, dumps(
+        {'traceEvents': events, 'displayTimeUnit': 'ms'}).encode())
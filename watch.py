@@ -0,0 +1,171 @@
+'''
+Watches agencies' image directories for changes, so that the page can be
+rebuilt as soon as photographs are added, removed, renamed, or edited.
+On Linux, inotify(7) is used through ctypes, so changes are noticed as they
+happen without rereading any directory; elsewhere, the directories are
+polled, which only takes a stat of each file.
+'''
+
+import os
+import select
+import struct
+from time import sleep
+
+from imagemeta import LIBC
+
+# These are for Linux inotify(7), which is not exposed by the os module
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+# Events which mean an image directory's contents changed
+IMAGE_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE\
+    | IN_DELETE
+# Events which mean an agency's image directory appeared
+ROOT_EVENTS = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+# struct inotify_event, followed by a name of its len field's length
+EVENT_FORMAT = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+READ_SIZE = 65536
+# Seconds to keep collecting events after the first, since copying in or
+# editing a photograph causes several in quick succession
+SETTLE_TIME = 0.1
+# Seconds between polls, when inotify is unavailable
+POLL_INTERVAL = 0.5
+
+class Watcher:
+    '''
+    Watches the subdirectories of string directory named by iterable
+    agencies (which needn't exist yet). Files whose names start with "." are
+    ignored, since these include image manifests, which are written on every
+    scan.
+    '''
+    def __init__(self, directory, agencies):
+        self.directory = directory
+        self.agencies = set(agencies)
+        self.fd = None
+        # Watch descriptors to agencies, or to None for directory itself
+        self.watches = dict()
+        inotify_init1 = getattr(LIBC, 'inotify_init1', None)
+        if inotify_init1:
+            fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+                self.add_watch(None, ROOT_EVENTS)
+                for agency in self.agencies:
+                    self.add_watch(agency, IMAGE_EVENTS)
+        if self.fd is None:
+            self.listings = {a: self.list(a) for a in self.agencies}
+
+    def add_watch(self, agency, mask):
+        '''
+        Starts watching the directory for string agency (or the directory
+        containing them, if agency is None) for events in integer mask, if
+        it exists.
+        '''
+        path = self.directory
+        if agency:
+            path = os.path.join(path, agency)
+        wd = LIBC.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd >= 0:
+            self.watches[wd] = agency
+
+    def wait(self):
+        '''
+        Blocks until any image changes, and returns a set of the agencies
+        whose images changed.
+        '''
+        if self.fd is None:
+            return self.poll()
+        changed = set()
+        while not changed:
+            select.select([self.fd], [], [])
+            changed |= self.read_events()
+        while select.select([self.fd], [], [], SETTLE_TIME)[0]:
+            changed |= self.read_events()
+        return changed
+
+    def read_events(self):
+        '''
+        Reads all pending inotify events, and returns a set of the agencies
+        they affect. Watches directories for any agencies which appear.
+        '''
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        i = 0
+        while i < len(data):
+            wd, mask, cookie, length = struct.unpack_from(
+                EVENT_FORMAT, data, i)
+            name = data[i + EVENT_SIZE:i + EVENT_SIZE + length]
+            name = os.fsdecode(name.rstrip(b'\0'))
+            i += EVENT_SIZE + length
+            if wd not in self.watches:
+                continue
+            agency = self.watches[wd]
+            if mask & IN_IGNORED:
+                # The directory itself was removed
+                del self.watches[wd]
+                if agency:
+                    changed.add(agency)
+            elif agency is None:
+                if mask & IN_ISDIR and name in self.agencies:
+                    self.add_watch(name, IMAGE_EVENTS)
+                    changed.add(name)
+            elif not name.startswith('.'):
+                changed.add(agency)
+        return changed
+
+    def poll(self):
+        '''
+        Lists every agency's directory every POLL_INTERVAL seconds until any
+        listing differs from the last, and returns a set of the agencies whose
+        listings differ.
+        '''
+        while True:
+            sleep(POLL_INTERVAL)
+            changed = set()
+            for agency in self.agencies:
+                listing = self.list(agency)
+                if listing != self.listings[agency]:
+                    self.listings[agency] = listing
+                    changed.add(agency)
+            if changed:
+                return changed
+
+    def list(self, agency):
+        '''
+        Returns a dictionary of names of files in the directory for string
+        agency to tuples of their inode numbers, sizes, and modification
+        times, or None if it doesn't exist.
+        '''
+        listing = dict()
+        try:
+            with os.scandir(os.path.join(self.directory, agency)) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # Removed since it was listed
+                        continue
+                    listing[entry.name] = (
+                        stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return listing
+
+    def close(self):
+        '''Stops watching, releasing the inotify instance if any.'''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None